@@ -0,0 +1,205 @@
+# Copyright (C) 2021-2023 Alexandre Dumont <adumont@gmail.com>
+#
+# SPDX-License-Identifier: GPL-3.0-only
+
+# Call-graph profiling: 65C02 subroutines and Forth threaded code
+#
+# We keep a stack of frames while the CPU runs, and add the cycles of each
+# instruction to the current stack:
+#
+# - JSR pushes a frame for the subroutine (asm routine), RTS pops it.
+# - "JMP (W)" (end of NEXT, EXEC) dispatches a Forth word: the word replaces
+#   the primitive on top of the stack, if any.
+# - do_COLON turns the word on top into a colon definition: it stays on the
+#   stack until EXIT pulls back the IP that COLON pushed.
+# - from NEXT to the next "JMP (W)", the primitive on top is replaced by NEXT,
+#   so the cost of the inner interpreter shows under the words that drive it.
+#
+# Frames entered through the hardware stack (JSR, COLON) remember the SP they
+# pushed down to, and are popped when an instruction that raises SP (RTS,
+# PLA, TXS...) takes it above. Words that play with the return stack (R> DROP
+# to exit the caller...) can thus end a frame early: it's a profile, not a
+# debugger.
+#
+# Cycles are kept per distinct stack (a tuple of frame keys), and names are
+# only resolved after the run: Forth words from the dictionary in memory,
+# routines from the symbols.
+
+from dictindex import DictionaryIndex
+
+OP_JSR     = 0x20
+OP_JMP_IND = 0x6C
+W          = 0xFE
+
+# instructions that can move SP up: RTS RTI PLA PLP PLX PLY TXS
+SP_UP = frozenset([ 0x60, 0x40, 0x68, 0x28, 0xFA, 0x7A, 0x9A ])
+
+# frame keys: CFA of a Forth word, or address of an asm routine | ASM
+ASM = 0x10000
+
+class CallGraph:
+
+    def __init__(self, mpu, symbols):
+        self.mpu = mpu
+        self.symbols = symbols
+        self.addr_NEXT = symbols.addrs.get("NEXT")
+        self.addr_COLON = symbols.addrs.get("do_COLON")
+        self.addr_LATEST = symbols.addrs.get("LATEST")
+
+        self.frames = []   # frame keys, outermost first
+        self.limits = []   # SP the frame returns above, None for a primitive
+        self.ids = {}      # stack (tuple of keys) --> id
+        self.cycles = []   # id --> cycles
+        self.current = 0
+        self._stack_changed()
+
+    def _stack_changed(self):
+        stack = tuple(self.frames)
+        i = self.ids.get(stack)
+        if i is None:
+            i = self.ids[stack] = len(self.cycles)
+            self.cycles.append(0)
+        self.current = i
+
+    def _push(self, key, limit):
+        self.frames.append(key)
+        self.limits.append(limit)
+        self._stack_changed()
+
+    def _primitive(self, key):
+        # replaces the primitive on top, if any
+        if self.limits and self.limits[-1] is None:
+            self.frames[-1] = key
+            self._stack_changed()
+        else:
+            self._push(key, None)
+
+    def _colon(self):
+        # COLON is about to push IP (2 bytes)
+        limit = self.mpu.sp - 2
+        if self.limits and self.limits[-1] is None:
+            self.limits[-1] = limit
+        else:
+            # entered without JMP (W) (cold start): name it after W
+            self._push(self.mpu.memory.data[W] + 256*self.mpu.memory.data[W+1], limit)
+
+    def _unwind(self, sp):
+        limits = self.limits
+        n = k = len(limits)
+        while k and (limits[k-1] is None or sp > limits[k-1]):
+            k -= 1
+        # primitives right above a frame still running stay
+        while k < n and limits[k] is None:
+            k += 1
+        if k < n:
+            # the primitive running (EXIT...) carries on in the caller
+            top = self.frames[-1] if limits[-1] is None else None
+            del self.frames[k:]
+            del limits[k:]
+            if top is None:
+                self._stack_changed()
+            else:
+                self._push(top, None)
+
+    def run(self, stop, stats=None, tracer=None, counts=None):
+        # Runs until stop() is true. Also fills stats (cycles per address)
+        # and counts (instructions per address) like the flat profile, and
+        # records the tracer if any.
+        mpu = self.mpu
+        data = mpu.memory.data
+        step = mpu.step
+        cycles = self.cycles
+        addr_NEXT = self.addr_NEXT
+        addr_COLON = self.addr_COLON
+        record = tracer.record if tracer else None
+        c = mpu.processorCycles
+
+        while True:
+            pc = mpu.pc
+            if pc == addr_NEXT:
+                self._primitive(addr_NEXT | ASM)
+            elif pc == addr_COLON:
+                self._colon()
+            op = data[pc]
+            if record:
+                record(mpu)
+            step()
+            now = mpu.processorCycles
+            cycles[self.current] += now - c
+            if stats is not None:
+                stats[pc] += now - c
+            if counts is not None:
+                counts[pc] += 1
+            c = now
+
+            if op == OP_JSR:
+                self._push(mpu.pc | ASM, mpu.sp)
+            elif op == OP_JMP_IND and data[pc+1] == W and data[pc+2] == 0:
+                self._primitive(mpu.pc)
+            elif op in SP_UP:
+                self._unwind(mpu.sp)
+
+            if stop():
+                break
+
+    def names(self):
+        # frame key --> name, with the dictionary as it is now
+        words = {}
+        if self.addr_LATEST is not None:
+            words = DictionaryIndex(self.mpu.memory, self.addr_LATEST).words()
+
+        names = {}
+        for stack in self.ids:
+            for key in stack:
+                if key in names:
+                    continue
+                addr = key & 0xFFFF
+                name = None
+                if not key & ASM:
+                    name = words.get(addr)
+                if name is None or ";" in name:
+                    # flamegraph tools split frames on ";"
+                    name = self.symbols.symbols.get(addr) if self.symbols else None
+                names[key] = name or "$%04X" % addr
+        return names
+
+    def totals(self):
+        # (inclusive, exclusive) cycles per frame key; a key that appears
+        # several times in a stack (recursion) is only counted once
+        inclusive = {}
+        exclusive = {}
+        for stack, i in self.ids.items():
+            c = self.cycles[i]
+            if not c or not stack:
+                continue
+            for key in set(stack):
+                inclusive[key] = inclusive.get(key, 0) + c
+            exclusive[stack[-1]] = exclusive.get(stack[-1], 0) + c
+        return inclusive, exclusive
+
+    def report(self, top=20):
+        names = self.names()
+        inclusive, exclusive = self.totals()
+        total = sum(self.cycles) or 1
+        lines = []
+        for title, forth in (("Forth words", True), ("asm routines", False)):
+            keys = [ k for k in inclusive if bool(k & ASM) != forth ]
+            keys.sort(key=inclusive.get, reverse=True)
+            lines.append("%-12s %12s %7s %12s %7s" % (title, "inclusive", "", "exclusive", ""))
+            for k in keys[:top]:
+                lines.append("%-12s %12d %6.2f%% %12d %6.2f%%" % (names[k],
+                    inclusive[k], 100.0 * inclusive[k] / total,
+                    exclusive.get(k, 0), 100.0 * exclusive.get(k, 0) / total))
+            lines.append("")
+        return "\n".join(lines)
+
+    def collapsed(self):
+        # "outer;...;inner cycles" lines (flamegraph.pl, speedscope...)
+        names = self.names()
+        lines = []
+        for stack, i in self.ids.items():
+            c = self.cycles[i]
+            if c:
+                lines.append("%s %d" % (";".join(names[k] for k in stack) or "(top)", c))
+        lines.sort()
+        return lines
@@ -7,29 +7,81 @@
 # SPDX-License-Identifier: GPL-3.0-only
 
 import os
+import sys
 import time
 import curses
 import threading
 import signal
 import locale
-from disass import render_instr
+from disass import format_instr
+from symtab import SymbolTable
+from memory import CerberusMemory
+from savestate import save_state, load_state
+from exectrace import TraceWriter
+from jit import BlockCache
+from hle import HLE, OFFLOADS
+from sampler import Sampler
+from heatmap import CountingMemory, Heatmap, HAVE_NUMPY
+from workload import send_key, MAILFLAG
 from queue import Queue
 
 import argparse
 
 from py65.devices.mpu65c02 import MPU as CMOS65C02
 from py65.utils.conversions import itoa
-from py65.memory import ObservableMemory
+
+# Cerberus 2080 6502 clock (BIOS "fast" and "slow" commands)
+CLOCK_PRESETS = { "fast": 8.0, "slow": 4.0 }
+
+def parse_mhz(value):
+    # --mhz: a preset or a frequency in MHz
+    if value in CLOCK_PRESETS:
+        return CLOCK_PRESETS[value]
+    try:
+        mhz = float(value)
+    except ValueError:
+        mhz = 0
+    if not mhz > 0:
+        raise argparse.ArgumentTypeError("expected fast, slow or a frequency in MHz, got %r" % value)
+    return mhz
 
 # Argument parsing
 parser = argparse.ArgumentParser()
 parser.add_argument('-r','--rom', help='binary rom file', default="forth-emu.bin")
 parser.add_argument('-a','--addr', help='address to load to', default=0xC000)
 parser.add_argument('-l','--logfile', help='filename of log', default=None)
+parser.add_argument('-T','--trace', help='binary execution trace file (see tracedump.py)', default=None)
+parser.add_argument('--trace-ring', help='only keep the last N trace records (in memory)', type=int, default=None)
 parser.add_argument('-s','--symbols', help='symbols file', default="forth-emu.lbl")
 parser.add_argument('-b','--breakpoint', help='set breakpoint (symbol)', default="do_BREAK")
+parser.add_argument('--fps', help='screen refresh rate (frames per second)', type=float, default=50)
+parser.add_argument('--pane-hz', help='debug pane refresh rate in continuous mode', type=float, default=10)
+parser.add_argument('--mhz', help='throttle to the real clock: fast (8MHz), slow (4MHz) or a frequency in MHz', type=parse_mhz, default=None)
+parser.add_argument('--save-state', help='save machine state to file on exit', default=None)
+parser.add_argument('--load-state', help='restore machine state from file', default=None)
+parser.add_argument('--jit', help='translate hot code blocks to Python (continuous mode; not with --trace/--logfile)', default=False, action='store_true')
+parser.add_argument('--hle', help='run hot primitives in Python (not cycle exact): all of them, or a comma separated list (see hle.py)', nargs='?', const=",".join(OFFLOADS), metavar='LIST', default=None)
+parser.add_argument('--sample', help='sampling profile: record PC, W and IP every N cycles, report on exit (see sampler.py)', type=int, default=None)
+parser.add_argument('--sample-out', help='with --sample, write the samples to this file, in collapsed format for flamegraph tools', default=None)
+parser.add_argument('--heatmap', help='count memory reads/writes and opcodes (needs NumPy, no --jit), report on exit and save them as PREFIX-*.npy/.pgm', metavar='PREFIX', default=None)
+parser.add_argument('--headless', help='run without curses UI (batch mode)', default=False, action='store_true')
+parser.add_argument('-i','--input', help='headless: keyboard input file (- for stdin)', default=None)
+parser.add_argument('--until', help='headless: stop when PC reaches symbol', default=None)
+parser.add_argument('--cycles', help='headless: stop after N clock cycles', type=int, default=None)
+parser.add_argument('--until-boot', help='headless: stop when BOOT flag is cleared', default=False, action='store_true')
 args = parser.parse_args()
 
+if args.addr and str(args.addr).startswith("0x"):
+    args.addr = int(args.addr,16)
+
+if args.hle:
+    for name in args.hle.split(","):
+        if name not in OFFLOADS:
+            parser.error("unknown --hle primitive %s (available: %s)" % (name, ",".join(OFFLOADS)))
+
+if args.heatmap and not HAVE_NUMPY:
+    parser.error("--heatmap needs NumPy (pip install numpy)")
+
 # stats = open("/tmp/stats", "w")  # a=append mode
 
 locale.setlocale(locale.LC_ALL, '')
@@ -37,32 +89,26 @@ code = locale.getpreferredencoding()
 
 exit_event = threading.Event()
 
-symbols = None
+# commands for the CPU thread: 1 (step), 0 (run continuously), None (exit).
+# In step by step mode the CPU thread blocks on it.
+queue_step = Queue()
+
+# curses isn't thread safe: every thread drawing on the screen takes this lock
+curses_lock = threading.Lock()
 
-def parseSymbolsFile(filename):
-    # file content should look like this:
-    # al 00C23D .do_PUSH1
-    # al 00C239 .__word_12
-    # al 00C239 .h_PUSH1
-    # al 00C22E .__word_11
-    symbols = {}
-    with open(filename) as file:
-        for line in file:
-            _, a, s = line.split(" ")
-            if s.startswith(".__word_") or s.startswith(".h_"):
-                # we discard those symbols
-                continue
-            symbols[int(a,16)]=s.strip()[1:]
-    return symbols
-
-def getSymbol(addr):
-    return symbols[max(k for k in symbols if k <= addr)]
-
-def getLabelAddr(label):
-    return [ k for k in symbols if symbols[k] == label ][0]
+symbols = None
+hle = None
+sampler = None
+heatmap = None
 
 if args.symbols:
-    symbols=parseSymbolsFile(args.symbols)
+    symbols=SymbolTable.load(args.symbols)
+    getSymbol = symbols.getSymbol
+    getLabelAddr = symbols.getLabelAddr
+
+# in continuous mode, we check the clock for a debug pane refresh every
+# PANE_CHECK_CYCLES emulated cycles
+PANE_CHECK_CYCLES = 10000
 
 addr_W    = 0x00FE
 addr_IP          = addr_W -2
@@ -86,8 +132,240 @@ addr_INPUT      = getLabelAddr("INPUT")
 addr_INP_IDX    = getLabelAddr("INP_IDX")
 addr_OK         = getLabelAddr("OK")
 
-def cpuThreadFunction(ch,win,dbgwin, queue, queue_step, logfile):
-    global symbols
+def load(memory, start_address, bytes):
+    memory[start_address:start_address + len(bytes)] = bytes
+
+def create_mpu(vram_write=None):
+    mpu = CMOS65C02()
+
+    m = CountingMemory() if args.heatmap else CerberusMemory()
+    m.data[0xF800:0xFCB0] = (0xFCAF-0xF800+1) * b"\x20"
+    if vram_write:
+        m.subscribe_to_write(range(0xF800,0xF800+30*40), vram_write)
+    mpu.memory = m
+
+    if args.rom:
+        f = open(args.rom, 'rb')
+        program = f.read()
+        f.close()
+    else:
+        # Dummy prog
+        program = [ 0xA9, 97, 0x8D, 0x01, 0xF0 ]
+
+    load(mpu.memory, args.addr, program)
+
+    # as we have stripped the vectors out of the binary, we need to populate
+    # the RESET vector, as CAT(BIOS) does.
+    mpu.memory[0xFFFC] = (args.addr & 0xFF)
+    mpu.memory[0xFFFD] = ( args.addr >> 8 ) & 0xFF
+
+    # Reset: RESET vector => PC
+    mpu.pc=mpu.WordAt(mpu.RESET)
+
+    return mpu
+
+def create_hle(mpu):
+    # Python versions of hot primitives (see hle.py), with --hle
+    if args.hle is None or not symbols:
+        return None
+    hle = HLE(mpu, symbols, args.hle.split(","))
+    return hle if hle.hooks else None
+
+def create_sampler(mpu):
+    return Sampler(mpu, symbols, args.sample) if args.sample and symbols else None
+
+def create_heatmap(mpu):
+    # wraps mpu.step, so create it before the run loop takes mpu.step
+    if not args.heatmap:
+        return None
+    return Heatmap(mpu)
+
+def heatmap_report(heatmap):
+    print(heatmap.report(symbols))
+    heatmap.save(args.heatmap)
+
+def sampler_report(sampler):
+    print(sampler.report())
+    if args.sample_out:
+        with open(args.sample_out, "w") as f:
+            for line in sampler.collapsed():
+                f.write(line + "\n")
+
+def dump_state(mpu, out=sys.stdout):
+    # 40x30 text screen, as rendered in the curses pane
+    data = mpu.memory.data
+    for row in range(30):
+        line = data[0xF800+40*row:0xF800+40*(row+1)]
+        out.write("".join(chr(c) if c else " " for c in line).rstrip() + "\n")
+
+    getWord = lambda a: data[a] + 256*data[(a+1) & 0xFFFF]
+
+    out.write("\n")
+    out.write("PC: %04X  Cycles: %d\n" % ( mpu.pc, mpu.processorCycles ) )
+    out.write("A:%02X  X:%02X  Y:%02X  S:%02X  P:%s\n" % ( mpu.a, mpu.x, mpu.y, mpu.sp, ( itoa(mpu.p, 2).rjust(8, '0') ) ) )
+    out.write("W: %04X  IP: %04X  G1: %04X  G2: %04X\n" % ( getWord(addr_W), getWord(addr_IP), getWord(addr_G1), getWord(addr_G2) ) )
+    out.write("LATEST: %04X  DP: %04X\n" % ( getWord(addr_LATEST), getWord(addr_DP) ) )
+
+class Throttle:
+    # Keeps the emulated clock in step with the wall clock. The CPU runs a
+    # quantum of cycles (based on mpu.processorCycles), then we sleep until
+    # the wall clock catches up, instead of sleeping after every instruction.
+
+    QUANTUM = 0.01  # seconds of emulated time between two syncs
+
+    def __init__(self, mhz):
+        self.set_mhz(mhz)
+
+    def set_mhz(self, mhz):
+        self.mhz = mhz
+        self.hz = mhz * 1e6
+        self.quantum = int(self.hz * self.QUANTUM)
+        self.t0 = None      # will rebase on next sync
+        self.c0 = 0
+        self.next_sync = 0
+
+    def sync(self, cycles):
+        now = time.monotonic()
+        t0, c0 = self.t0, self.c0   # set_mhz() may be called from the UI thread
+
+        if t0 is not None:
+            delay = t0 + (cycles - c0) / self.hz - now
+            if delay > 0:
+                time.sleep(delay)
+                now += delay
+            elif delay < -0.1:
+                # we're late (paused, step by step, or the host is too slow)
+                # don't try to catch up, restart from here
+                self.t0 = None
+
+        if self.t0 is None:
+            self.t0 = now
+            self.c0 = cycles
+
+        self.next_sync = cycles + self.quantum
+
+def run_headless():
+    # Batch mode: no curses, no debug pane. Keys are fed from a file (or stdin)
+    # and we stop on a symbol, a cycle budget or when BOOT is cleared
+    mpu = create_mpu()
+    data = mpu.memory.data  # our own polling doesn't go through mpu.memory[]
+
+    keys = b""
+    if args.load_state:
+        # keys that were still pending when the state was saved come first
+        keys = load_state(args.load_state, mpu)
+
+    if args.input == "-":
+        keys += sys.stdin.buffer.read()
+    elif args.input:
+        with open(args.input, 'rb') as f:
+            keys += f.read()
+    keys = list(keys)
+    keys.reverse() # so we can pop() them in order
+
+    addr_until = getLabelAddr(args.until) if args.until else None
+    max_cycles = None
+    if args.cycles is not None:
+        max_cycles = mpu.processorCycles + args.cycles
+
+    throttle = Throttle(args.mhz) if args.mhz else None
+
+    tracer = TraceWriter(args.trace, mpu, args.trace_ring) if args.trace else None
+
+    hle = create_hle(mpu)
+    hooks = hle.hooks if hle else {}
+    sampler = create_sampler(mpu)
+    heatmap = create_heatmap(mpu)
+
+    # the JIT runs whole blocks: make them end where we check the PC
+    jit = None
+    if args.jit and not (tracer or heatmap):
+        stops = set(hooks)
+        if addr_until is not None:
+            stops.add(addr_until)
+        jit = BlockCache(mpu, stops)
+    step = jit.step if jit else mpu.step
+
+    while True:
+        if throttle and mpu.processorCycles >= throttle.next_sync:
+            throttle.sync(mpu.processorCycles)
+
+        if mpu.pc == addr_until:
+            break
+        if max_cycles is not None and mpu.processorCycles >= max_cycles:
+            break
+        if args.until_boot and data[addr_BOOT] == 0:
+            break
+
+        hook = hooks.get(mpu.pc)
+        if not (hook and hook()):
+            # no hook, or the hook declined (WORD/PARSE on an empty buffer)
+            if tracer:
+                tracer.record(mpu)
+            step()
+
+        if sampler and mpu.processorCycles >= sampler.next:
+            sampler.sample()
+
+        # next key, if the kernel has consumed the previous one
+        if keys and data[MAILFLAG] == 0:
+            send_key(mpu, keys.pop())
+
+    if tracer:
+        tracer.close()
+
+    if args.save_state:
+        keys.reverse()
+        save_state(args.save_state, mpu, keys)
+
+    dump_state(mpu)
+    if hle:
+        print(hle.report())
+    if sampler:
+        sampler_report(sampler)
+    if heatmap:
+        heatmap_report(heatmap)
+
+class ScreenRenderer(threading.Thread):
+    # The CPU thread only records which VRAM cells were written (and their
+    # last value). This thread draws them at a fixed frame rate and flushes
+    # all the pending window updates with a single doupdate() per frame, so
+    # the emulated CPU speed doesn't depend on the terminal speed.
+
+    def __init__(self, win, fps):
+        super().__init__(daemon=True)
+        self.win = win
+        self.period = 1.0 / fps
+        self.dirty = {}     # VRAM address --> last value written
+        self.lock = threading.Lock()    # mark() vs the swap in flush()
+
+    def mark(self, address, value):
+        with self.lock:
+            self.dirty[address] = value
+
+    def flush(self):
+        # swap the dict first, the CPU thread keeps marking into a new one
+        with self.lock:
+            dirty, self.dirty = self.dirty, {}
+
+        with curses_lock:
+            for address, value in dirty.items():
+                x,y = divmod(address-0xF800,40)
+                if value == 0:
+                    value = 0x20
+                try:
+                    self.win.addstr(x,y, chr(value))
+                except curses.error:
+                    pass
+            self.win.noutrefresh()
+            curses.doupdate()
+
+    def run(self):
+        while not exit_event.wait(self.period):
+            self.flush()
+
+def cpuThreadFunction(ch,screen,dbgwin, queue, queue_step, logfile, throttle):
+    global symbols, hle, sampler, heatmap
 
     started=False
 
@@ -98,55 +376,54 @@ def cpuThreadFunction(ch,win,dbgwin, queue, queue_step, logfile):
     symbol_depth=3
     syms = symbol_depth*[""]
 
-    def load(memory, start_address, bytes):
-        memory[start_address:start_address + len(bytes)] = bytes
-
     def vram_write(address, value):
         if not started:
             return
 
-        address -= 0xF800
-        x,y = divmod(address,40)
-        if value == 0:
-            value = 0x20
-        try:
-            win.addstr(x,y, chr(value))
-            win.noutrefresh()
-            curses.doupdate()
-        except curses.error:
-            pass
+        screen.mark(address, value)
 
+    # the emulator's own reads go to memory.data: no I/O subscriber is
+    # triggered, and --heatmap only counts the CPU's accesses
     def getByte(address):
-        return mpu.memory[address]
+        return mpu.memory.data[address & 0xFFFF]
 
 
     def getWord(address):
-        return mpu.memory[address] + 256*mpu.memory[address+1]
-
+        data = mpu.memory.data
+        return data[address & 0xFFFF] + 256*data[(address+1) & 0xFFFF]
 
-    def disass_pane(mode, instr, syms):
-        dbgwin.addstr(0,10, "Cycles: %d" % mpu.processorCycles )
 
+    def registers():
         log_registers = "A:%02X  X:%02X  Y:%02X  S:%02X  P:%s" % ( mpu.a, mpu.x, mpu.y, mpu.sp, ( itoa(mpu.p, 2).rjust(8, '0') ) )
 
         _w=getWord(addr_W)
         _ip=getWord(addr_IP)
         log_forth_reg1 = " W: %04X  IP: %04X" % ( _w, _ip )
 
-        _here = getWord(addr_DP)
-        dbgwin.addstr(8,0, "LATEST: %04X  DP: %04X" % ( getWord(addr_LATEST), _here ) )
+        return log_registers, log_forth_reg1
 
-        curr_instr = render_instr( [ "%04X" % mpu.pc, "%02X" % getByte(mpu.pc), "%02X" % getByte(mpu.pc+1), "%02X" % getByte(mpu.pc+2) ] )
+    def current_instr():
+        pc = mpu.pc
+        data = mpu.memory.data
+        curr_instr = format_instr(pc, data[pc], data[(pc+1) & 0xFFFF], data[(pc+2) & 0xFFFF])
         if symbols:
             curr_instr += getSymbol(mpu.pc)
+        return curr_instr
 
-        if logfile:
-            logfile.write(" | ".join([log_registers, log_forth_reg1, curr_instr]) + "\n")
+    def log_instr():
+        # called for every instruction when --logfile is set
+        logfile.write(" | ".join([*registers(), current_instr()]) + "\n")
+
+    def disass_pane(mode, instr, syms):
+        dbgwin.addstr(0,10, "Cycles: %d" % mpu.processorCycles )
 
-        # stats.write("%10d %s\n" % ( mpu.processorCycles, curr_instr ) )
+        _here = getWord(addr_DP)
+        dbgwin.addstr(8,0, "LATEST: %04X  DP: %04X" % ( getWord(addr_LATEST), _here ) )
 
         if mode == 1: #step-by-step mode
             # these registers will only be updated in step-by-step mode
+            log_registers, log_forth_reg1 = registers()
+
             dbgwin.addstr(0, 0, "PC: %04X" % mpu.pc )
 
             dbgwin.addstr(2,0, log_registers )
@@ -158,8 +435,8 @@ def cpuThreadFunction(ch,win,dbgwin, queue, queue_step, logfile):
             dbgwin.addstr(7,4, log_forth_reg2 )
 
             # Show disassembled code
-            instr.append( curr_instr )
-            instr = instr[-hist_depth:] # keep last "hist_depth"
+            instr.append( current_instr() )
+            del instr[:-hist_depth] # keep last "hist_depth"
             for i in range(len(instr)):
                 dbgwin.addstr(12+i,0, (instr[i]+10*" ")[0:40] )
 
@@ -191,100 +468,115 @@ def cpuThreadFunction(ch,win,dbgwin, queue, queue_step, logfile):
         dbgwin.noutrefresh()
 
 
-    def nmi():
-        # triggers a NMI IRQ in the processor
-        # this is very similar to the BRK instruction
-        mpu.stPushWord(mpu.pc)
-        mpu.p &= ~mpu.BREAK
-        mpu.stPush(mpu.p | mpu.UNUSED)
-        mpu.p |= mpu.INTERRUPT
-        mpu.pc = mpu.WordAt(mpu.NMI)
-        mpu.processorCycles += 7
-
-
-    mpu = CMOS65C02()
-    mpu.memory = 0x10000 * [0xEA]
-    mpu.memory[0xF800:0xFCAF] =  (0xFCAF-0xF800+1)* [0x20]
-
-    addrWidth = mpu.ADDR_WIDTH
-
-    m = ObservableMemory(subject=mpu.memory, addrWidth=addrWidth)
-    m.subscribe_to_write(range(0xF800,0xF800+30*40), vram_write)
-    mpu.memory = m
-
-    if args.addr and str(args.addr).startswith("0x"):
-        args.addr = int(args.addr,16)
-
-    if args.rom:
-        f = open(args.rom, 'rb')
-        program = f.read()
-        f.close()
-    else:
-        # Dummy prog
-        program = [ 0xA9, 97, 0x8D, 0x01, 0xF0 ]
-
-    load(mpu.memory, args.addr, program)
-
-    # as we have stripped the vectors out of the binary, we need to populate
-    # the RESET vector, as CAT(BIOS) does.
-    mpu.memory[0xFFFC] = (args.addr & 0xFF)
-    mpu.memory[0xFFFD] = ( args.addr >> 8 ) & 0xFF
+    mpu = create_mpu(vram_write)
 
-    # Reset: RESET vector => PC
-    mpu.pc=getWord(mpu.RESET)
+    if args.load_state:
+        for key in load_state(args.load_state, mpu):
+            queue.put(key)
+        # the memory was restored behind the VRAM subscriber's back: redraw
+        for address in range(0xF800,0xF800+30*40):
+            screen.mark(address, mpu.memory.data[address])
 
     started=True
 
-    delay=0
-    # delay=1
-
-    dbgwin.addstr(1,26, "NV-BDIZC" )
+    tracer = TraceWriter(args.trace, mpu, args.trace_ring) if args.trace else None
 
     # mode_step = 0       # continuous execution
     mode_step = 1       # step by step execution
 
-    disass_pane(mode_step, instr, syms)
-    curses.doupdate()
+    with curses_lock:
+        dbgwin.addstr(1,26, "NV-BDIZC" )
+        disass_pane(mode_step, instr, syms)
 
-    run_next_step = 0
+    pane_period = 1.0 / args.pane_hz
+    next_pane_time = 0
+    next_pane_cycles = 0
 
-    while not exit_event.is_set():
-        if mpu.pc == getLabelAddr(args.breakpoint) or mpu.pc == getLabelAddr("do_BREAK"): # breakpoint
-            queue_step.put(1)
+    breakpoints = { getLabelAddr(args.breakpoint), getLabelAddr("do_BREAK") }
 
-        if not queue_step.empty():
-            mode_step = queue_step.get()
-            
-            run_next_step = 1
+    hle = create_hle(mpu)
+    hooks = hle.hooks if hle else {}
+    sampler = create_sampler(mpu)
+    heatmap = create_heatmap(mpu)
 
-        if mode_step == 1 and run_next_step == 0:
-            continue
+    # the JIT is only used when running free, and its blocks end at the
+    # breakpoints and hooks
+    jit = None
+    if args.jit and not (tracer or logfile or heatmap):
+        jit = BlockCache(mpu, breakpoints | set(hooks))
 
-        if mode_step == 1:
-            run_next_step = 0
+    while not exit_event.is_set():
+        if mpu.pc in breakpoints: # breakpoint
+            queue_step.put(1)
 
-        # stats.write("%d %04X" % ( mpu.pc, mpu.processorCycles ) )
+        if mode_step == 1 or not queue_step.empty():
+            # in step by step mode, sleep until we're told what to do next
+            cmd = queue_step.get()
+            if cmd is None:
+                break
+            mode_step = cmd
+
+        # step by step (and so at a breakpoint), the kernel's code is run
+        hook = hooks.get(mpu.pc) if mode_step == 0 else None
+        if not (hook and hook()):
+            # no hook, or the hook declined (WORD/PARSE on an empty buffer)
+            if tracer:
+                tracer.record(mpu)
+            if jit and mode_step == 0:
+                jit.step()
+            else:
+                mpu.step()
 
-        mpu.step()
+        if sampler and mpu.processorCycles >= sampler.next:
+            sampler.sample()
 
         # any key pressed?
-        if mpu.memory[0x0200] == 0 and not queue.empty():
-            mpu.memory[0x0200]=1
-            mpu.memory[0x0201]=queue.get()
-            nmi()
+        if mpu.memory.data[MAILFLAG] == 0 and not queue.empty():
+            send_key(mpu, queue.get())
 
-        disass_pane(mode_step, instr, syms)
+        if logfile:
+            log_instr()
 
-        curses.doupdate()
-        time.sleep(delay)
+        if mode_step == 1:
+            with curses_lock:
+                disass_pane(mode_step, instr, syms)
+        elif mpu.processorCycles >= next_pane_cycles:
+            # running free: only look at the clock every PANE_CHECK_CYCLES,
+            # and redraw the pane at most args.pane_hz times per second
+            next_pane_cycles = mpu.processorCycles + PANE_CHECK_CYCLES
+            now = time.monotonic()
+            if now >= next_pane_time:
+                next_pane_time = now + pane_period
+                with curses_lock:
+                    disass_pane(mode_step, instr, syms)
+
+        if throttle and mpu.processorCycles >= throttle.next_sync:
+            throttle.sync(mpu.processorCycles)
+
+    if tracer:
+        tracer.close()
+
+    if args.save_state:
+        keys = []
+        while not queue.empty():
+            keys.append(queue.get())
+        save_state(args.save_state, mpu, keys)
 
 def exit():
     exit_event.set()
+    queue_step.put(None)    # wake up the CPU thread
 
     curses.nocbreak()
     curses.echo()
     curses.endwin()
 
+    if hle:
+        print(hle.report())
+    if sampler:
+        sampler_report(sampler)
+    if heatmap:
+        heatmap_report(heatmap)
+
     quit()
 
 def main(stdscr):
@@ -323,15 +615,20 @@ def main(stdscr):
     curses.doupdate()
 
     queue = Queue()
-    queue_step = Queue()
 
     if args.logfile:
         logfile = open(args.logfile, "w")  # a=append mode
     else:
         logfile=None
 
+    # screen renderer thread, redraws the computer screen at a fixed rate
+    screen = ScreenRenderer(cpuwin, args.fps)
+    screen.start()
+
+    throttle = Throttle(args.mhz) if args.mhz else None
+
     # create computer thread
-    t=threading.Thread( target=cpuThreadFunction, args=("", cpuwin, dbgwin, queue, queue_step, logfile) )
+    t=threading.Thread( target=cpuThreadFunction, args=("", screen, dbgwin, queue, queue_step, logfile, throttle) )
     t.start()
 
     # main thread for getting keypress
@@ -345,13 +642,23 @@ def main(stdscr):
         elif key == 0x168:    # End key
             # Continuous execution
             queue_step.put(0)
+        elif key == curses.KEY_F5 and throttle:
+            # toggle between fast and slow clock
+            if throttle.mhz == CLOCK_PRESETS["fast"]:
+                throttle.set_mhz(CLOCK_PRESETS["slow"])
+            else:
+                throttle.set_mhz(CLOCK_PRESETS["fast"])
+            msgwin.erase()
+            msgwin.addstr(0,0, 'clock: %g MHz' % throttle.mhz )
         elif key == 0x1b:
             # escape key exits
             msgwin.erase()
             msgwin.addstr(0,0, 'Exiting...')
             exit_event.set()
-            msgwin.noutrefresh()
-            curses.doupdate()
+            queue_step.put(None)
+            with curses_lock:
+                msgwin.noutrefresh()
+                curses.doupdate()
             time.sleep(0.2)
             break
         else:
@@ -366,8 +673,9 @@ def main(stdscr):
 
             queue.put(key)
             
-        msgwin.noutrefresh()
-        curses.doupdate()
+        with curses_lock:
+            msgwin.noutrefresh()
+            curses.doupdate()
 
 
     msgwin.erase()
@@ -387,5 +695,8 @@ def signal_handler(signum, frame):
 if __name__ == '__main__':
     # Must happen BEFORE calling the wrapper, else escape key has a 1 second delay after pressing:
     os.environ.setdefault('ESCDELAY','100') # in mS; default: 1000
+    if args.headless:
+        run_headless()
+        quit()
     signal.signal(signal.SIGINT, signal_handler)
     curses.wrapper(main)
@@ -0,0 +1,224 @@
+# Copyright (C) 2021-2023 Alexandre Dumont <adumont@gmail.com>
+#
+# SPDX-License-Identifier: GPL-3.0-only
+
+# Hash index of the Forth dictionary, for FIND offloading
+#
+# FIND walks the linked list of headers from LATEST, comparing names: the
+# longer the dictionary, the slower it gets. DictionaryIndex keeps a
+# name --> headers map instead, built once by walking the dictionary, and
+# brought up to date when LATEST changes: new definitions are linked in front
+# of headers already indexed, and FORGET (see MARKER) moves LATEST back to one
+# of them. LATEST is compared on each lookup rather than watched with a write
+# subscriber, so raw writes (save states...) are seen too. A header we know is
+# only taken for one we indexed if its name and link haven't changed: after
+# FORGET, a new word can be compiled at the address of a forgotten one (and
+# LATEST can even end up with the same value).
+#
+# Header: [link (2)] [flags|len (1)] [name (len)]
+#
+# The hidden flag is read from memory on each lookup (":" hides the word being
+# defined until ";", HIDE/UNHIDE flip it in place), and the name of the header
+# found is checked against the memory. When the dictionary doesn't look like
+# what was indexed, the index is rebuilt and a plain walk gives the answer.
+# (A name changed in place is only noticed when the old name is looked up, and
+# so are older definitions replaced under the same LATEST between two
+# lookups: FORGET, then several words compiled without a FIND.)
+
+HIDDEN_FLAG = 0x40
+LEN_MASK    = 0x1F
+
+# a header is at least 3 bytes long, a longer chain must be a loop
+MAX_HEADERS = 0x10000 // 3
+
+class DictionaryIndex:
+
+    def __init__(self, memory, addr_LATEST):
+        self.data = memory.data
+        self.addr_LATEST = addr_LATEST
+
+        self.rebuilds = 0
+        self.walks = 0
+        self.reset()
+
+    def reset(self):
+        self.latest = None  # LATEST when last synced
+        self.order = []     # headers, oldest first
+        self.position = {}  # header --> index in order
+        self.name_of = {}   # header --> name, as indexed
+        self.names = {}     # name --> headers, oldest first
+        self.lengths = {}   # name length --> headers, oldest first
+
+    def getWord(self, address):
+        return self.data[address] + 256*self.data[(address+1) & 0xFFFF]
+
+    def name(self, header):
+        n = self.data[header+2] & LEN_MASK
+        return bytes(self.data[header+3:header+3+n])
+
+    def chain(self, header):
+        # headers from header down to the oldest one, or None if it loops
+        headers = []
+        while header != 0:
+            if len(headers) == MAX_HEADERS:
+                return None
+            headers.append(header)
+            header = self.getWord(header)
+        return headers
+
+    def _append(self, header):
+        self.position[header] = len(self.order)
+        self.order.append(header)
+        name = self.name_of[header] = self.name(header)
+        self.names.setdefault(name, []).append(header)
+        self.lengths.setdefault(len(name), []).append(header)
+
+    def _indexed(self, header):
+        # is the header at this (indexed) address still the one we indexed?
+        i = self.position[header]
+        link = self.order[i-1] if i else 0
+        return self.getWord(header) == link and self.name(header) == self.name_of[header]
+
+    def _pop(self):
+        header = self.order.pop()
+        del self.position[header]
+        # the newest header is the last one in each list
+        name = self.name_of.pop(header)
+        self.names[name].pop()
+        self.lengths[len(name)].pop()
+
+    def sync(self):
+        latest = self.getWord(self.addr_LATEST)
+        if latest == self.latest and (latest == 0 or self._indexed(latest)):
+            return True
+
+        # walk the new headers, down to one we know
+        new = []
+        header = latest
+        while header != 0:
+            if header in self.position:
+                if self._indexed(header):
+                    break
+                # forgotten, and a new word took its place: drop it and
+                # what's newer, and go on walking
+                keep = self.position[header]
+                while len(self.order) > keep:
+                    self._pop()
+            if len(new) == MAX_HEADERS:
+                self.reset()
+                return False
+            new.append(header)
+            header = self.getWord(header)
+
+        if header == 0 and self.order:
+            # a whole new chain
+            self.reset()
+            self.rebuilds += 1
+
+        if header in self.position:
+            # FORGET: drop what's newer than where the chain joins
+            keep = self.position[header] + 1
+            while len(self.order) > keep:
+                self._pop()
+            if not all(self._indexed(h) for h in self.order):
+                # older headers were replaced too (several definitions
+                # since the last lookup): start over
+                return self.rebuild()
+
+        for header in reversed(new):
+            self._append(header)
+        self.latest = latest
+        return True
+
+    def rebuild(self):
+        self.reset()
+        self.rebuilds += 1
+        return self.sync()
+
+    def walk(self, word):
+        # what the kernel's FIND does: header of the newest visible word
+        # with this name, or 0
+        self.walks += 1
+        data = self.data
+        n = len(word)
+        for header in self.chain(self.getWord(self.addr_LATEST)) or ():
+            flags = data[header+2]
+            if not flags & HIDDEN_FLAG and flags & LEN_MASK == n and data[header+3:header+3+n] == word:
+                return header
+        return 0
+
+    def find(self, word):
+        # word: name as bytes. Returns the header, or 0 if not found
+        word = bytes(word)
+        if not self.sync():
+            return self.walk(word)
+
+        data = self.data
+        n = len(word)
+        for header in reversed(self.names.get(word, ())):
+            flags = data[header+2]
+            if flags & LEN_MASK != n or data[header+3:header+3+n] != word:
+                # renamed or overwritten behind our back
+                self.rebuild()
+                return self.walk(word)
+            if not flags & HIDDEN_FLAG:
+                return header
+        return 0
+
+    def oldest(self, length):
+        # oldest visible header with a name of that length (the last one
+        # FIND compares when the word isn't found), or 0
+        if not self.sync():
+            return 0
+        for header in self.lengths.get(length, ()):
+            if not self.data[header+2] & HIDDEN_FLAG:
+                return header
+        return 0
+
+    def words(self):
+        # code field address --> name of the visible and hidden words, the
+        # newest definition wins
+        words = {}
+        for header in self.chain(self.getWord(self.addr_LATEST)) or ():
+            name = self.name(header)
+            words.setdefault(header + 3 + len(name), name.decode("ascii", "replace"))
+        return words
+
+if __name__ == '__main__':
+    # self test: python3 dictindex.py
+    from memory import CerberusMemory
+
+    LATEST = 0x0202
+    memory = CerberusMemory(0)
+
+    def define(header, link, name):
+        memory.write(header, bytes([link & 0xFF, link >> 8, len(name)]) + name)
+        memory.write(LATEST, bytes([header & 0xFF, header >> 8]))
+
+    index = DictionaryIndex(memory, LATEST)
+    define(0x1000, 0, b"DUP")
+    define(0x1010, 0x1000, b"FOO")
+    assert index.find(b"FOO") == 0x1010
+
+    # FORGET FOO, and BAR is compiled at its address before the next lookup
+    define(0x1010, 0x1000, b"BAR")
+    assert index.find(b"BAR") == 0x1010
+    assert index.find(b"FOO") == 0
+
+    # FORGET both, SWAP and ROT compiled in their place (same LATEST)
+    define(0x1000, 0, b"SWAP")
+    define(0x1010, 0x1000, b"ROT")
+    assert index.find(b"SWAP") == 0x1000
+    assert index.find(b"DUP") == 0 and index.find(b"BAR") == 0
+
+    # FORGET ROT, then OVER, NIP and DROP: the new chain joins the indexed
+    # one at NIP, whose header is the same, but ROT below it is gone
+    define(0x1020, 0x1010, b"NIP")
+    assert index.find(b"NIP") == 0x1020
+    define(0x1010, 0x1000, b"OVER")
+    define(0x1020, 0x1010, b"NIP")
+    define(0x1030, 0x1020, b"DROP")
+    assert index.find(b"OVER") == 0x1010
+    assert index.find(b"ROT") == 0
+
+    print("ok")
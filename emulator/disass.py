@@ -1,3 +1,5 @@
+#!/usr/bin/env python3
+
 # Copyright (C) 2021-2023 Alexandre Dumont <adumont@gmail.com>
 #
 # SPDX-License-Identifier: GPL-3.0-only
@@ -242,20 +244,122 @@ modes = {
     15: [ '(zp),y', 2 ],
 }
 
+# Operand format for each mode (the relative mode is computed)
+
+operand_formats = {
+    'a':      "$%04X",
+    '(a,x)':  "($%04X,x)",
+    'a,x':    "$%04X,x",
+    'a,y':    "$%04X,y",
+    '(a)':    "($%04X)",
+    'A':      "A",
+    '#':      "#$%02X",
+    'i':      "",
+    'r':      "$%04X",
+    's':      "",
+    'zp':     "$%02X",
+    '(zp,x)': "($%02X,x)",
+    'zp,x':   "$%02X,x",
+    'zp,y':   "$%02X,y",
+    '(zp)':   "($%02X)",
+    '(zp),y': "($%02X),y",
+}
+
+# Decode table, indexed by the opcode byte:
+# (mnemonic, mode, length, operand format), or None for an invalid opcode
+
+DECODE = 256 * [None]
+for _op, (_o, _m) in opcodes.items():
+    _m, _l = modes[_m]
+    DECODE[_op] = (_o, _m, _l, operand_formats[_m])
+
 def isValidOpcode(b):
-    return b in opcodes.keys()
+    return DECODE[b] is not None
 
 # decode an opcode byte b
 # returns mnemonic, mode, length
 def decode(b):
     if isinstance(b,str):
         b=hex2dec(b)
-    if isValidOpcode(b):
-        o, m = opcodes[b]
-        m, l = modes[m]
-        return o, m, l
-    else:
+    d = DECODE[b]
+    if d is None:
         return None,None,None
+    return d[:3]
+
+def instr_text(addr, op, b1=0, b2=0):
+    # "mnemonic operand" of the instruction at addr, from its bytes (ints)
+    d = DECODE[op]
+    if d is None:
+        return ".byte $%02X" % op
+    o, m, l, fmt = d
+    if l == 1:
+        return "%s %s" % (o, fmt) if fmt else o
+    if m == 'r':
+        operand = fmt % ((addr + 2 + (b1 - 0x100 if b1 > 0x7F else b1)) & 0xFFFF)
+    elif l == 2:
+        operand = fmt % b1
+    else:
+        operand = fmt % (b1 + 256*b2)
+    return "%s %s" % (o, operand)
+
+def format_instr(addr, op, b1=0, b2=0):
+    # same output as render_instr, from ints
+    d = DECODE[op]
+    if d is None:
+        return "%04X: %s %-8s " % (addr, ".byte", "$%02X" % op)
+    o, m, l, fmt = d
+    if l == 1:
+        operand = fmt
+    elif m == 'r':
+        operand = fmt % ((addr + 2 + (b1 - 0x100 if b1 > 0x7F else b1)) & 0xFFFF)
+    elif l == 2:
+        operand = fmt % b1
+    else:
+        operand = fmt % (b1 + 256*b2)
+    return "%04X: %s %-8s " % (addr, o, operand)
+
+def target(addr, op, b1=0, b2=0):
+    # address an instruction refers to (absolute, zp or branch), or None
+    d = DECODE[op]
+    if d is None or d[2] == 1 or d[1] == '#':
+        return None
+    if d[1] == 'r':
+        return (addr + 2 + (b1 - 0x100 if b1 > 0x7F else b1)) & 0xFFFF
+    if d[2] == 2:
+        return b1
+    return b1 + 256*b2
+
+def disassemble(data, start=None, end=None, base=0, symbols=None):
+    # Yields (address, length, text, label) for the instructions in
+    # [start, end). data (bytes, bytearray, memoryview...) holds the memory
+    # from address base on. With a SymbolTable, label is the label at the
+    # address (or None) and the text ends with the label it refers to.
+    if start is None:
+        start = base
+    if end is None:
+        end = base + len(data)
+    labels = symbols.symbols if symbols else {}
+
+    addr = start
+    while addr < end:
+        i = addr - base
+        op = data[i]
+        d = DECODE[op]
+        l = d[2] if d else 1
+        if addr + l > end:
+            # cut by the end of the range
+            op, l, d = None, 1, None
+            text = ".byte $%02X" % data[i]
+        else:
+            b1 = data[i+1] if l > 1 else 0
+            b2 = data[i+2] if l > 2 else 0
+            text = instr_text(addr, op, b1, b2)
+            if labels and l > 1 and d[1] != '#':
+                name = labels.get(target(addr, op, b1, b2))
+                if name:
+                    text = "%-16s; %s" % (text, name)
+        yield addr, l, text, labels.get(addr)
+        addr += l
 
 def hex2dec(s):
     return int(s,16)
@@ -332,3 +436,36 @@ def render_instr(_args):
     
     # return ("%04X: %-10s %s %-8s %-4s %s " % (addr, hexdump.upper(), o, operand, m, comment))
     return ("%04X: %s %-8s " % (addr, o, operand))
+
+if __name__ == '__main__':
+    import sys
+    import signal
+    import argparse
+
+    from symtab import SymbolTable
+
+    parser = argparse.ArgumentParser(description="disassemble a ROM image")
+    parser.add_argument('rom', help='binary rom file')
+    parser.add_argument('-a','--addr', help='address the rom is loaded at', default="0xC000")
+    parser.add_argument('-s','--symbols', help='symbols file', default=None)
+    parser.add_argument('--start', help='first address (default: start of the rom)', default=None)
+    parser.add_argument('--end', help='end address, excluded (default: end of the rom)', default=None)
+    args = parser.parse_args()
+
+    # don't choke when piped into head/less
+    signal.signal(signal.SIGPIPE, signal.SIG_DFL)
+
+    with open(args.rom, 'rb') as f:
+        rom = f.read()
+
+    base = int(args.addr, 0)
+    start = int(args.start, 0) if args.start else None
+    end = int(args.end, 0) if args.end else None
+    symbols = SymbolTable.load(args.symbols) if args.symbols else None
+
+    out = []
+    for addr, l, text, label in disassemble(rom, start, end, base, symbols):
+        if label:
+            out.append("%s:" % label)
+        out.append("    %04X  %-8s  %s" % (addr, " ".join("%02X" % b for b in rom[addr-base:addr-base+l]), text))
+    sys.stdout.write("\n".join(out) + "\n")
@@ -0,0 +1,89 @@
+# Copyright (C) 2021-2023 Alexandre Dumont <adumont@gmail.com>
+#
+# SPDX-License-Identifier: GPL-3.0-only
+
+# Compact binary execution trace
+#
+# The file starts with a header:
+#   magic "CERBTRC1", record size (u16), padding, base cycles (u64)
+# followed by fixed size records, one per instruction, taken before the
+# instruction is executed:
+#   cycles since previous record (u32), PC (u16), instruction bytes (3),
+#   A, X, Y, S, P (u8 each), W (u16), IP (u16)
+#
+# Records go through a large write buffer. In ring mode only the last N
+# records are kept in memory, and written when the trace is closed.
+#
+# tracedump.py decodes (symbolizes and disassembles) a trace.
+
+import struct
+
+MAGIC = b"CERBTRC1"
+HEADER = struct.Struct("<8sH6xQ")
+RECORD = struct.Struct("<IH3sBBBBBHH")
+
+addr_W  = 0x00FE
+addr_IP = addr_W - 2
+
+class TraceWriter:
+
+    def __init__(self, filename, mpu, ring=None, buffering=1<<20):
+        self.file = open(filename, 'wb', buffering=buffering)
+        self.data = mpu.memory.data   # raw memory, no I/O side effects
+        self.last_cycles = mpu.processorCycles
+        self.base_cycles = mpu.processorCycles
+
+        self.ring = ring
+        if ring:
+            self.buffer = bytearray(ring * RECORD.size)
+            self.count = 0
+        else:
+            self.file.write(HEADER.pack(MAGIC, RECORD.size, self.base_cycles))
+
+    def record(self, mpu):
+        data = self.data
+        pc = mpu.pc
+        cycles = mpu.processorCycles
+
+        fields = ( cycles - self.last_cycles, pc, data[pc:pc+3],
+            mpu.a, mpu.x, mpu.y, mpu.sp, mpu.p,
+            data[addr_W] | data[addr_W+1] << 8, data[addr_IP] | data[addr_IP+1] << 8 )
+
+        self.last_cycles = cycles
+
+        if self.ring:
+            RECORD.pack_into(self.buffer, (self.count % self.ring) * RECORD.size, *fields)
+            self.count += 1
+        else:
+            self.file.write(RECORD.pack(*fields))
+
+    def close(self):
+        if self.ring:
+            # oldest record first
+            n = min(self.count, self.ring)
+            start = (self.count % self.ring) * RECORD.size if self.count > self.ring else 0
+            records = self.buffer[start:n * RECORD.size] + self.buffer[:start]
+
+            # base cycles = cycles before the first record we kept
+            base = self.last_cycles - sum(d for d, *_ in RECORD.iter_unpack(records))
+
+            self.file.write(HEADER.pack(MAGIC, RECORD.size, base))
+            self.file.write(records)
+
+        self.file.close()
+
+def read_trace(filename):
+    # yields (cycles, pc, instr_bytes, a, x, y, s, p, w, ip)
+    # where cycles is the absolute cycle count at that instruction
+    with open(filename, 'rb') as f:
+        magic, size, cycles = HEADER.unpack(f.read(HEADER.size))
+        if magic != MAGIC or size != RECORD.size:
+            raise ValueError("%s: not a trace file" % filename)
+
+        while True:
+            chunk = f.read(RECORD.size * 4096)
+            if not chunk:
+                break
+            for delta, *fields in RECORD.iter_unpack(chunk[:len(chunk) - len(chunk) % RECORD.size]):
+                cycles += delta
+                yield (cycles, *fields)
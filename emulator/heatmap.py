@@ -0,0 +1,195 @@
+# Copyright (C) 2021-2023 Alexandre Dumont <adumont@gmail.com>
+#
+# SPDX-License-Identifier: GPL-3.0-only
+
+# Memory access heatmap and opcode histogram (needs NumPy)
+#
+# CountingMemory is a CerberusMemory that appends the address of every read
+# and write done through mpu.memory[] to a list (instruction fetches
+# included; the JIT works on memory.data and isn't seen, the primitives run
+# in Python with --hle go through mpu.memory[] and are counted as if the CPU
+# had made their accesses). It only counts once a Heatmap is attached: the
+# boot, or the warm-up up to profiler.py --start, don't pile up in the lists.
+# Heatmap wraps mpu.step to also append the opcode run, and every BATCH
+# instructions the lists are folded into NumPy counters with bincount, so the
+# per access cost is a list append.
+#
+# Heatmap.save(prefix) writes:
+#   prefix-reads.npy, prefix-writes.npy   64K counters
+#   prefix-opcodes.npy                    256 counters
+#   prefix-reads.pgm, prefix-writes.pgm   256x256 images (row = page, log scale)
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+HAVE_NUMPY = np is not None
+
+from memory import CerberusMemory
+from disass import opcodes, modes
+
+# instructions between two flushes of the lists
+BATCH = 0x10000
+
+# Forth kernel registers in zero page (name, address, bytes)
+ZP_REGISTERS = [
+    ("W",    0xFE, 2),
+    ("IP",   0xFC, 2),
+    ("G2",   0xFA, 2),
+    ("G1",   0xF8, 2),
+    ("DP",   0xF6, 2),
+    ("LINE", 0xF4, 2),
+    ("ROW",  0xF3, 1),
+    ("COL",  0xF2, 1),
+    ("DTOP", 0xF0, 2),
+]
+
+class CountingMemory(CerberusMemory):
+
+    def __init__(self, fill=0xEA):
+        super().__init__(fill)
+        self.counting = False   # set by Heatmap
+        self.reads = []
+        self.writes = []
+
+    def __getitem__(self, address):
+        if self.counting:
+            self.reads.append(address)
+        return CerberusMemory.__getitem__(self, address)
+
+    def __setitem__(self, address, value):
+        if self.counting:
+            self.writes.append(address)
+        CerberusMemory.__setitem__(self, address, value)
+
+def _bincount(addresses, size):
+    try:
+        a = np.array(addresses, dtype=np.int64)
+    except TypeError:
+        # slices (raw loads...) aren't counted
+        a = np.array([ x for x in addresses if isinstance(x, int) ], dtype=np.int64)
+    # addresses out of the 16 bits range are counted again once wrapped
+    # by CerberusMemory, drop them
+    a = a[(a >= 0) & (a < size)]
+    return np.bincount(a, minlength=size).astype(np.uint64)
+
+class Heatmap:
+
+    def __init__(self, mpu):
+        if np is None:
+            raise RuntimeError("the heatmap needs NumPy (pip install numpy)")
+        if not isinstance(mpu.memory, CountingMemory):
+            raise TypeError("the heatmap needs a CountingMemory")
+
+        self.mpu = mpu
+        self.memory = mpu.memory
+        self.data = mpu.memory.data
+
+        self.reads = np.zeros(0x10000, np.uint64)
+        self.writes = np.zeros(0x10000, np.uint64)
+        self.opcodes = np.zeros(256, np.uint64)
+        self.ops = []
+
+        # what was done before (loading the ROM...) doesn't count
+        self.memory.reads.clear()
+        self.memory.writes.clear()
+        self.memory.counting = True
+
+        self._step = mpu.step
+        mpu.step = self.step
+
+    def step(self):
+        ops = self.ops
+        ops.append(self.data[self.mpu.pc])
+        self._step()
+        if len(ops) >= BATCH:
+            self.flush()
+
+    def flush(self):
+        memory = self.memory
+        if memory.reads:
+            self.reads += _bincount(memory.reads, 0x10000)
+            memory.reads.clear()
+        if memory.writes:
+            self.writes += _bincount(memory.writes, 0x10000)
+            memory.writes.clear()
+        if self.ops:
+            self.opcodes += np.bincount(np.array(self.ops, dtype=np.int64), minlength=256).astype(np.uint64)
+            self.ops.clear()
+
+    def mode_counts(self):
+        # addressing mode name --> instructions run
+        counts = {}
+        for op, n in enumerate(self.opcodes.tolist()):
+            if n:
+                mode = modes[opcodes[op][1]][0] if op in opcodes else "??"
+                counts[mode] = counts.get(mode, 0) + n
+        return counts
+
+    def report(self, symbols=None, top=20):
+        self.flush()
+        lines = []
+        total = int(self.opcodes.sum()) or 1
+
+        lines.append("%-6s %-7s %12s" % ("opcode", "mode", "count"))
+        order = np.argsort(self.opcodes, kind="stable")[::-1]
+        for op in order[:top].tolist():
+            n = int(self.opcodes[op])
+            if not n:
+                break
+            if op in opcodes:
+                mnemonic, mode = opcodes[op][0], modes[opcodes[op][1]][0]
+            else:
+                mnemonic, mode = "??", "??"
+            lines.append("%02X %-4s %-7s %12d %6.2f%%" % (op, mnemonic, mode, n, 100.0 * n / total))
+
+        lines.append("")
+        lines.append("%-14s %12s" % ("mode", "count"))
+        counts = self.mode_counts()
+        for mode in sorted(counts, key=counts.get, reverse=True):
+            lines.append("%-14s %12d %6.2f%%" % (mode, counts[mode], 100.0 * counts[mode] / total))
+
+        lines.append("")
+        lines.append("%-14s %12s %12s" % ("register", "reads", "writes"))
+        for name, addr, size in ZP_REGISTERS:
+            lines.append("%-14s %12d %12d" % (name,
+                int(self.reads[addr:addr+size].sum()), int(self.writes[addr:addr+size].sum())))
+
+        for title, counts in (("read", self.reads), ("written", self.writes)):
+            lines.append("")
+            lines.append("%-14s %12s" % ("most " + title, "count"))
+            for a in np.argsort(counts, kind="stable")[::-1][:top].tolist():
+                n = int(counts[a])
+                if not n:
+                    break
+                lines.append("$%04X %-8s %12d" % (a, location(a, symbols)[:8], n))
+
+        return "\n".join(lines)
+
+    def save(self, prefix):
+        self.flush()
+        np.save(prefix + "-reads.npy", self.reads)
+        np.save(prefix + "-writes.npy", self.writes)
+        np.save(prefix + "-opcodes.npy", self.opcodes)
+        for name, counts in (("reads", self.reads), ("writes", self.writes)):
+            write_pgm(prefix + "-" + name + ".pgm", counts)
+
+def location(addr, symbols=None):
+    # name of a kernel register, the stack or the closest label
+    for name, a, size in ZP_REGISTERS:
+        if a <= addr < a + size:
+            return name if addr == a else name + "+%d" % (addr - a)
+    if addr >> 8 == 1:
+        return "stack"
+    return (symbols.getSymbol(addr) if symbols and addr >= 0x200 else None) or ""
+
+def write_pgm(filename, counts):
+    # 256x256 grey image (row = page), log scale, the hottest byte is white
+    image = np.log1p(counts.astype(np.float64)).reshape(256, 256)
+    top = image.max()
+    if top > 0:
+        image *= 255.0 / top
+    with open(filename, "wb") as f:
+        f.write(b"P5\n256 256\n255\n")
+        f.write(image.round().astype(np.uint8).tobytes())
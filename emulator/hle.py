@@ -0,0 +1,408 @@
+# Copyright (C) 2021-2023 Alexandre Dumont <adumont@gmail.com>
+#
+# SPDX-License-Identifier: GPL-3.0-only
+
+# High-level emulation (HLE) of hot Forth primitives
+#
+# Some kernel primitives spend a lot of 6502 cycles on work that is trivial
+# in Python (walking the dictionary, copying memory, dividing...). Like
+# xcompiler does for FIND, when the PC reaches one of them we do the work in
+# Python on the machine (data stack, variables, G1/G2...) and continue at
+# NEXT. The registers NEXT overwrites anyway (A, Y, P, W) and the memory
+# below the stack pointers are not reproduced.
+#
+# Offloads are registered with the @offload(name, symbol) decorator, and the
+# emulator looks the PC up in HLE.hooks (address --> offload) before each
+# step. An offload can decline a call by returning False, without changing
+# anything: the kernel's code then runs as usual. Offloaded calls take no
+# cycles: to report what they save, the first call, and then one every
+# SAMPLE_EVERY, also runs the kernel's version on a copy of the machine,
+# counts its cycles until NEXT and checks it left the same data stack.
+#
+# With verify=True every call is also run by the kernel, and any difference
+# in the machine state (see HLE.differences) raises OffloadMismatch.
+
+from py65.devices.mpu65c02 import MPU as CMOS65C02
+
+from memory import CerberusMemory
+from dictindex import DictionaryIndex, LEN_MASK
+
+addr_W    = 0x00FE
+addr_IP   = addr_W -2
+addr_G2   = addr_IP-2
+addr_G1   = addr_G2-2
+addr_DTOP = 0x00F0
+
+HIDDEN_FLAG = 0x40
+
+SAMPLE_EVERY = 64
+MAX_SAMPLE_CYCLES = 10000000
+
+# bytes right below the data stack the kernel can use as scratch
+STACK_SCRATCH = 8
+
+class OffloadMismatch(Exception):
+    pass
+
+# name --> (symbol, function)
+OFFLOADS = {}
+
+def offload(name, symbol):
+    def register(func):
+        OFFLOADS[name] = (symbol, func)
+        return func
+    return register
+
+class Offload:
+
+    def __init__(self, hle, name, addr, func):
+        self.hle = hle
+        self.name = name
+        self.addr = addr
+        self.func = func
+
+        self.calls = 0
+        self.samples = 0
+        self.sampled_cycles = 0
+        self.mismatches = 0
+
+    def __call__(self):
+        # True if done in Python (PC is then NEXT), False if declined: PC is
+        # unchanged and the caller must let the kernel run it
+        hle = self.hle
+        before = None
+        if hle.verify or (hle.sample_every and self.calls % hle.sample_every == 0):
+            before = hle.save()
+
+        if self.func(hle) is False:
+            return False # declined, the kernel does it
+        self.calls += 1
+        hle.mpu.pc = hle.addr_NEXT
+
+        if before:
+            shadow = hle.run_kernel(before)
+            self.samples += 1
+            self.sampled_cycles += shadow.processorCycles
+            if hle.verify:
+                diffs = hle.differences(shadow)
+                if diffs:
+                    self.mismatches += 1
+                    raise OffloadMismatch("%s at $%04X differs from the kernel: %s" % (
+                        self.name, self.addr, ", ".join(diffs[:8])))
+            elif not hle.same_stack(shadow):
+                self.mismatches += 1
+        return True
+
+    def saved(self):
+        # estimated cycles saved
+        if not self.samples:
+            return 0
+        return self.calls * self.sampled_cycles // self.samples
+
+class HLE:
+
+    def __init__(self, mpu, symbols, names=None, sample_every=SAMPLE_EVERY, verify=False):
+        self.mpu = mpu
+        self.memory = mpu.memory
+        self.symbols = symbols
+        self.sample_every = sample_every
+        self.verify = verify
+        self.addr_NEXT = symbols.addrs.get("NEXT")
+
+        names = list(OFFLOADS if names is None else names)
+        for name in names:
+            if name not in OFFLOADS:
+                raise ValueError("unknown offload: %s (available: %s)" % (name, ", ".join(OFFLOADS)))
+
+        self.hooks = {}     # address --> Offload
+        if self.addr_NEXT is None:
+            return # not a Forth kernel?
+        for name in names:
+            symbol, func = OFFLOADS[name]
+            addr = symbols.addrs.get(symbol)
+            if addr is None:
+                continue # not in this kernel
+            self.hooks[addr] = Offload(self, name, addr, func)
+
+        # KBD_RET is $0A but in the Cerberus (hw) stage 2 ROM
+        self.kbd_ret = symbols.addrs.get("KBD_RET", 0x0A)
+
+        addr_LATEST = symbols.addrs.get("LATEST")
+        self.dictionary = DictionaryIndex(self.memory, addr_LATEST) if addr_LATEST is not None else None
+
+    def label(self, name):
+        return self.symbols.addrs.get(name)
+
+    def getByte(self, address):
+        return self.memory[address]
+
+    def getWord(self, address):
+        return self.memory[address] + 256*self.memory[address+1]
+
+    def putWord(self, address, value):
+        self.memory[address] = value & 0xFF
+        self.memory[address+1] = (value >> 8) & 0xFF
+
+    def save(self):
+        mpu = self.mpu
+        return bytes(self.memory.data), (mpu.pc, mpu.a, mpu.x, mpu.y, mpu.sp, mpu.p)
+
+    def run_kernel(self, state=None):
+        # runs the kernel's version of the primitive on a copy of the
+        # machine (state from save(), default now), without the I/O
+        # subscribers, until NEXT
+        data, registers = state or self.save()
+        memory = CerberusMemory()
+        memory.data[:] = data
+
+        shadow = CMOS65C02(memory=memory)
+        shadow.pc, shadow.a, shadow.x, shadow.y, shadow.sp, shadow.p = registers
+
+        while shadow.pc != self.addr_NEXT and shadow.processorCycles < MAX_SAMPLE_CYCLES:
+            shadow.step()
+        return shadow
+
+    def same_stack(self, shadow):
+        x = self.mpu.x
+        return ( shadow.x == x and
+                 shadow.memory.data[x+2:addr_DTOP+2] == self.memory.data[x+2:addr_DTOP+2] )
+
+    def differences(self, shadow):
+        # what the offload left different from the kernel, but what NEXT
+        # overwrites (A, Y, P, W) and the scratch below the stack pointers
+        mpu = self.mpu
+        diffs = []
+        for reg in ("x", "sp"):
+            if getattr(shadow, reg) != getattr(mpu, reg):
+                diffs.append("%s %02X/%02X" % (reg.upper(), getattr(shadow, reg), getattr(mpu, reg)))
+
+        x = min(shadow.x, mpu.x)
+        skip = set(range(max(0, x + 2 - STACK_SCRATCH), x + 2)) | {addr_W, addr_W+1}
+        skip.update(range(0x100, 0x101 + min(shadow.sp, mpu.sp)))
+
+        a, b = shadow.memory.data, self.memory.data
+        if a != b:
+            for address in range(0x10000):
+                if a[address] != b[address] and address not in skip:
+                    diffs.append("$%04X %02X/%02X" % (address, a[address], b[address]))
+        return diffs
+
+    def report(self):
+        lines = []
+        for o in sorted(self.hooks.values(), key=lambda o: o.name):
+            line = "HLE %-8s %8d calls, ~%d cycles saved" % (o.name, o.calls, o.saved())
+            if o.mismatches:
+                line += ", %d/%d MISMATCHES" % (o.mismatches, o.samples)
+            lines.append(line)
+        return "\n".join(lines)
+
+@offload("FIND", "do_FIND")
+def find(hle):
+    # ( addr len -- header|0 )
+    m = hle.memory
+    x = hle.mpu.x
+    addr = hle.getWord(x+4)
+    length = m[x+2]         # LO byte only, like the kernel
+    n = length or 256       # STRCMP compares Y-1 down to 0
+    word = m[addr:addr+n]
+
+    hle.putWord(addr_G2, addr)
+
+    if hle.dictionary and 0 < length <= LEN_MASK:
+        # G1 is left on the last name compared: the one found, or else the
+        # oldest visible one of the same length
+        found = hle.dictionary.find(word)
+        last = found or hle.dictionary.oldest(length)
+        if last:
+            hle.putWord(addr_G1, last+3)
+        hle.putWord(x+4, found)
+        hle.mpu.x = x+2 # DROP
+        return
+
+    # lengths no name can have (0 compares 256 bytes), walk like the kernel
+    header = hle.getWord(hle.label("LATEST"))
+    found = 0
+    while True:
+        flags = m[header+2]
+        if not flags & HIDDEN_FLAG and flags & 0x1F == length:
+            hle.putWord(addr_G1, header+3)
+            if m[header+3:header+3+n] == word:
+                found = header
+                break
+        header = hle.getWord(header)
+        if header == 0:
+            break
+
+    hle.putWord(x+4, found)
+    hle.mpu.x = x+2 # DROP
+
+def parse_token(hle, sepr, x):
+    # ( -- addr len ) _parse: next token in the INPUT buffer, separated by
+    # sepr, (0 0 at the end of the line or on a \ comment). X is the stack
+    # pointer once the separator (PARSE) is dropped.
+    # Declines when the buffer runs out: the kernel then refills it (getline)
+    m = hle.memory
+    inp = hle.label("INPUT")
+    inp_idx = hle.label("INP_IDX")
+    length = m[hle.label("INP_LEN")]
+    kbd_ret = hle.kbd_ret
+
+    i = m[inp_idx]
+    def key():
+        nonlocal i
+        if i == length:
+            return None
+        c = m[inp + i]
+        i = (i+1) & 0xFF
+        return c
+
+    c = sepr
+    while c == sepr:
+        c = key()
+        if c is None:
+            return False
+
+    if c == ord('\\') and c != kbd_ret:
+        while c != kbd_ret:
+            c = key()
+            if c is None:
+                return False
+
+    if c == kbd_ret:
+        token = (0, 0)
+        eol = True
+    else:
+        start = i
+        while c != sepr and c != kbd_ret:
+            c = key()
+            if c is None:
+                return False
+        token = (inp + start - 1, (i - start) & 0xFF)
+        eol = c == kbd_ret and c != sepr
+        m[addr_G1] = start
+
+    m[hle.label("SEPR")] = sepr
+    m[inp_idx] = i
+    if eol and not m[hle.label("BOOT")]:
+        ok = hle.label("OK")
+        m[ok] = (m[ok] + 1) & 0xFF  # show the prompt
+    hle.putWord(x, token[0])
+    hle.putWord(x-2, token[1])
+    hle.mpu.x = x-4
+
+@offload("WORD", "do_WORD")
+def word(hle):
+    return parse_token(hle, 0x20, hle.mpu.x)
+
+@offload("PARSE", "do_PARSE")
+def parse(hle):
+    x = hle.mpu.x
+    return parse_token(hle, hle.memory[x+2], x+2)
+
+@offload("CMOVE", "do_CMOVE")
+def cmove(hle):
+    # ( src dst len -- )
+    m = hle.memory
+    x = hle.mpu.x
+    n = m[x+2] or 256 # LO byte only, 0 copies 256 bytes
+    src = hle.getWord(x+6)
+    dst = hle.getWord(x+4)
+
+    if src + n <= 0x10000 and dst + n <= 0x10000 and (dst >= src or dst + n <= src):
+        # the kernel copies from the end: same as a memmove here
+        m[dst:dst+n] = m[src:src+n]
+    else:
+        for i in reversed(range(n)):
+            m[(dst+i) & 0xFFFF] = m[(src+i) & 0xFFFF]
+
+    hle.putWord(addr_G1, src)
+    hle.putWord(addr_G2, dst)
+    hle.mpu.x = x+6
+
+@offload("UM/MOD", "do_STAR_UM_DIV_MOD")
+def um_div_mod(hle):
+    # ( ud u -- quotient remainder ), the assembler part of UM/MOD
+    # same shift-and-subtract as the kernel, so G1 ends the same
+    x = hle.mpu.x
+    d = hle.getWord(x+2)
+    hi = hle.getWord(x+4)
+    lo = hle.getWord(x+6)
+
+    if hi >= d:
+        # overflow or /0
+        hi = lo = 0xFFFF
+    else:
+        c = 0
+        for _ in range(16):
+            lo = (lo << 1) | c
+            c, lo = lo >> 16, lo & 0xFFFF
+            hi = (hi << 1) | c
+            c, hi = hi >> 16, hi & 0xFFFF
+            g1 = c | ((hi - d) & 0xFF) << 8
+            if (c << 16 | hi) >= d:
+                hi = (hi - d) & 0xFFFF
+                c = 1
+            else:
+                c = 0
+        lo = ((lo << 1) | c) & 0xFFFF
+        hle.putWord(addr_G1, g1)
+
+    hle.putWord(x+4, hi)
+    hle.putWord(x+6, lo)
+    hle.mpu.x = x+2 # DROP
+
+# char --> hex digit value (nibble_asc_to_value): 0-9 and A-F, whatever BASE
+NIBBLE = [None] * 256
+for c in range(ord('0'), ord('9')+1):
+    NIBBLE[c] = c - ord('0')
+for c in range(ord('A'), ord('F')+1):
+    NIBBLE[c] = c - ord('A') + 10
+
+NUMBER_PREFIXES = { ord('#'): 10, ord('$'): 16, ord('%'): 2, ord('o'): 8 }
+
+@offload("NUMBER", "do_NUMBER")
+def number(hle):
+    # ( addr len -- value flag ), flag is 0 if not a number
+    m = hle.memory
+    x = hle.mpu.x
+    addr = hle.getWord(x+4)
+    length = m[x+2]
+
+    m[hle.label("ERROR")] = 0
+    m[addr_G1] = length
+
+    y = 0
+    base = NUMBER_PREFIXES.get(m[addr])
+    if base:
+        y = 1
+    else:
+        base = m[hle.label("BASE")]
+
+    value = 0
+    bcd = None
+    while True:
+        digit = NIBBLE[m[(addr+y) & 0xFFFF]]
+        if digit is None:
+            break
+        value = (value + digit) & 0xFFFF
+
+        y = (y+1) & 0xFF
+        if y == length:
+            break
+
+        # mulG2xBASE (any base but 2, 8, 10 multiplies by 16)
+        if base == 10:
+            bcd = (value << 1) & 0xFFFF
+            value = (value * 10) & 0xFFFF
+        else:
+            value = (value << {2: 1, 8: 3}.get(base, 4)) & 0xFFFF
+
+    hle.putWord(addr_G2, value)
+    if bcd is not None and hle.label("SCRATCH") is not None:
+        hle.putWord(hle.label("SCRATCH"), bcd)
+
+    if digit is None:
+        hle.putWord(x+2, 0)
+    else:
+        hle.putWord(x+4, value)
+        m[x+2] = x # non zero
@@ -0,0 +1,533 @@
+# Copyright (C) 2021-2023 Alexandre Dumont <adumont@gmail.com>
+#
+# SPDX-License-Identifier: GPL-3.0-only
+
+# Basic block translation cache (a small "JIT") for the 65C02
+#
+# py65 interprets one instruction per mpu.step(), with several Python calls
+# for each one (dispatch, addressing mode, operation, flags...). Here we
+# decode a run of instructions once, generate the source of a Python
+# function doing the same work with the registers in local variables, and
+# cache the compiled function by its start address. The Forth inner
+# interpreter (NEXT, DOCOL...) runs the same few blocks millions of times.
+#
+# A block follows unconditional jumps (JMP, JSR, BRA), translates both
+# sides of conditional branches, and ends at dynamic jumps (JMP (W), RTS...)
+# or after MAX_INSTR instructions. It also ends before:
+#   - "stop" addresses, where the caller needs to see the PC (breakpoints,
+#     Python hooks like do_FIND...)
+#   - instructions we don't translate (BRK, RTI, WAI, undocumented...) and
+#     decimal mode ADC/SBC, which are left to py65
+#   - code in I/O pages
+#
+# Semantics and cycle counts follow py65 (we use its cycletime/extracycles
+# tables), so a run gives the same results with or without the JIT, but the
+# caller only sees the machine between blocks, not between instructions.
+#
+# Forth compiles into RAM: every page holding translated code is watched
+# (CerberusMemory.watch_page), and a write to a byte of a block drops the
+# block. The memory must be a CerberusMemory, with its I/O subscriptions
+# done before running. Raw writes (memory.write(), memory.data...) are not
+# seen: call flush() after those.
+
+MAX_INSTR = 48  # instructions per block (all paths)
+THRESHOLD = 8   # executions before a block gets translated
+
+LENGTHS = {
+    'imp': 1, 'acc': 1,
+    'imm': 2, 'zpg': 2, 'zpx': 2, 'zpy': 2, 'inx': 2, 'iny': 2, 'zpi': 2, 'rel': 2,
+    'abs': 3, 'abx': 3, 'aby': 3, 'ind': 3, 'iax': 3,
+}
+
+BRANCHES = {
+    'BPL': 'not p & 0x80', 'BMI': 'p & 0x80',
+    'BVC': 'not p & 0x40', 'BVS': 'p & 0x40',
+    'BCC': 'not p & 0x01', 'BCS': 'p & 0x01',
+    'BNE': 'not p & 0x02', 'BEQ': 'p & 0x02',
+}
+
+# value --> N and Z flags
+NZ = tuple((v & 0x80) if v else 0x02 for v in range(256))
+
+class BlockCache:
+
+    def __init__(self, mpu, stops=(), threshold=THRESHOLD):
+        self.mpu = mpu
+        self.memory = mpu.memory
+        self.stops = set(stops)
+        self.threshold = threshold
+
+        self.blocks = {}   # start --> function, or False if we can't translate
+        self.hits = {}     # start --> executions (not translated yet)
+        self.covers = {}   # start --> addresses of the block's code bytes
+        self.owners = {}   # address --> starts of the blocks covering it
+        self.page_count = 256 * [0]  # page --> number of addresses in owners
+
+        # set when a write drops a block, running blocks then exit
+        self.stale = False
+
+        self.compiled = 0
+        self.invalidated = 0
+
+        self.env = {
+            'mpu': mpu, 'data': self.memory.data, 'rp': self.memory.read_pages,
+            'wp': self.memory.write_pages, 'NZ': NZ, 'cache': self,
+        }
+
+    def step(self):
+        # runs one block (or one instruction through py65)
+        mpu = self.mpu
+        pc = mpu.pc
+        block = self.blocks.get(pc)
+
+        if block is None:
+            hits = self.hits.get(pc, 0) + 1
+            self.hits[pc] = hits
+            if hits >= self.threshold:
+                block = self._compile(pc)
+
+        if block and not mpu.waiting and not block():
+            return
+        mpu.step()
+
+    def add_stop(self, address):
+        self.stops.add(address)
+        self.flush()
+
+    def flush(self):
+        for start in list(self.covers):
+            self._drop(start)
+        self.blocks.clear()
+        self.hits.clear()
+
+    def _drop(self, start):
+        del self.blocks[start]
+        self.hits[start] = 0
+        for address in self.covers.pop(start):
+            starts = self.owners[address]
+            starts.remove(start)
+            if not starts:
+                del self.owners[address]
+                page = address >> 8
+                self.page_count[page] -= 1
+                if self.page_count[page] == 0:
+                    self.memory.unwatch_page(page)
+
+    def _code_write(self, address):
+        starts = self.owners.get(address)
+        if starts:
+            for start in list(starts):
+                self._drop(start)
+                self.invalidated += 1
+            self.stale = True
+
+    def _compile(self, start):
+        t = _Translator(self, start)
+        t.path(start)
+
+        if not t.count:
+            self.blocks[start] = False
+            return False
+
+        src = "def block(mpu=mpu, data=data, rp=rp, wp=wp, NZ=NZ, cache=cache):\n"
+        src += "    ex = 0\n"
+        src += "    a = mpu.a; x = mpu.x; y = mpu.y; sp = mpu.sp; p = mpu.p\n"
+        src += "\n".join(t.lines) + "\n"
+
+        ns = {}
+        exec(compile(src, "<block %04X>" % start, "exec"), self.env, ns)
+        block = ns['block']
+
+        self.blocks[start] = block
+        self.covers[start] = t.covered
+        for address in t.covered:
+            starts = self.owners.get(address)
+            if starts is None:
+                starts = self.owners[address] = []
+                page = address >> 8
+                if self.page_count[page] == 0:
+                    self.memory.watch_page(page, self._code_write)
+                self.page_count[page] += 1
+            starts.append(start)
+
+        self.compiled += 1
+        return block
+
+    def report(self):
+        return "JIT: %d blocks translated, %d invalidated" % (self.compiled, self.invalidated)
+
+class _Translator:
+    # generates the body of one block
+
+    def __init__(self, cache, start):
+        self.start = start
+        self.stops = cache.stops
+        self.data = cache.memory.data
+        self.rp = cache.memory.read_pages
+        mpu = cache.mpu
+        self.disassemble = mpu.disassemble
+        self.cycletime = mpu.cycletime
+        self.extracycles = mpu.extracycles
+
+        self.lines = []
+        self.covered = set()
+        self.count = 0
+        self.budget = MAX_INSTR
+
+        # state of the current path
+        self.indent = "    "
+        self.cyc = 0          # cycles so far (static part, "ex" has the rest)
+        self.dirty = set()    # registers to write back
+        self.visited = set()
+
+    def emit(self, line):
+        self.lines.append(self.indent + line)
+
+    def exit(self, pc, bail=False):
+        for r in sorted(self.dirty):
+            self.emit("mpu.%s = %s" % (r, r))
+        self.emit("mpu.pc = %s" % (pc if isinstance(pc, str) else "0x%04X" % pc))
+        self.emit("mpu.processorCycles += %d + ex" % self.cyc)
+        self.emit("return 1" if bail else "return")
+
+    def path(self, pc):
+        # translates from pc until the path exits
+        data = self.data
+        while True:
+            op = data[pc]
+            name, mode = self.disassemble[op]
+            length = LENGTHS.get(mode, 1)
+            addresses = [(pc + i) & 0xFFFF for i in range(length)]
+
+            gen = getattr(self, "op_" + name.rstrip("01234567"), None)
+            if ( gen is None or self.budget == 0 or pc in self.visited
+                 or (pc in self.stops and pc != self.start)
+                 or any(self.rp[a >> 8] is not None for a in addresses) ):
+                self.exit(pc)
+                return
+
+            self.visited.add(pc)
+            self.covered.update(addresses)
+            self.count += 1
+            self.budget -= 1
+
+            lo = data[addresses[1]] if length > 1 else 0
+            w = lo | data[addresses[2]] << 8 if length > 2 else lo
+            nxt = (pc + length) & 0xFFFF
+
+            pc = gen(op, name, mode, pc, nxt, lo, w)
+            if pc is None:
+                return
+
+    # memory access
+
+    def read(self, addr):
+        # addr: static address or "ea"
+        if isinstance(addr, int):
+            addr &= 0xFFFF
+            if self.rp[addr >> 8] is None:
+                return "data[0x%04X]" % addr
+            return "rp[0x%02X](0x%04X)" % (addr >> 8, addr)
+        return "(data[%s] if rp[%s >> 8] is None else rp[%s >> 8](%s))" % (addr, addr, addr, addr)
+
+    def read_page(self, page, expr):
+        # expr is an address inside page
+        if self.rp[page] is None:
+            return "data[%s]" % expr
+        return "rp[0x%02X](%s)" % (page, expr)
+
+    def write(self, addr, value, nxt=None):
+        # if nxt is given, exit there if the write dropped a block
+        if isinstance(addr, int):
+            addr &= 0xFFFF
+            self.emit("h = wp[0x%02X]" % (addr >> 8))
+            addr = "0x%04X" % addr
+        else:
+            self.emit("h = wp[%s >> 8]" % addr)
+        self.emit("if h is None:")
+        self.emit("    data[%s] = %s" % (addr, value))
+        self.emit("else:")
+        self.emit("    h(%s, %s)" % (addr, value))
+        if nxt is not None:
+            self.emit("    if cache.stale:")
+            indent = self.indent
+            self.indent += "        "
+            self.emit("cache.stale = False")
+            self.exit(nxt)
+            self.indent = indent
+
+    def address(self, op, mode, lo, w):
+        # effective address: a static address, or "ea" (emits its computation)
+        if mode == 'zpg':
+            return lo
+        if mode == 'abs':
+            return w
+        if mode in ('zpx', 'zpy'):
+            self.emit("ea = (%s + 0x%02X) & 0xFF" % (mode[2], lo))
+        elif mode in ('abx', 'aby'):
+            r = mode[2]
+            self.emit("ea = (%s + 0x%04X) & 0xFFFF" % (r, w))
+            if self.extracycles[op] and w & 0xFF:
+                # page crossing
+                self.emit("if %s > 0x%02X: ex += 1" % (r, 0xFF - (w & 0xFF)))
+        elif mode == 'inx':
+            self.emit("t = (x + 0x%02X) & 0xFF" % lo)
+            self.emit("ea = %s | %s << 8" % (self.read_page(0, "t"), self.read_page(0, "(t + 1) & 0xFF")))
+        elif mode == 'iny':
+            self.emit("ea = %s | %s << 8" % (self.read(lo), self.read((lo + 1) & 0xFF)))
+            if self.extracycles[op]:
+                self.emit("if (ea & 0xFF) + y > 0xFF: ex += 1")
+            self.emit("ea = (ea + y) & 0xFFFF")
+        elif mode == 'zpi':
+            self.emit("ea = %s | %s << 8" % (self.read(lo), self.read(lo + 1)))
+        else:
+            raise ValueError(mode)
+        return "ea"
+
+    def operand(self, op, mode, lo, w):
+        if mode == 'imm':
+            return "0x%02X" % lo
+        self.emit("v = %s" % self.read(self.address(op, mode, lo, w)))
+        return "v"
+
+    def flagsNZ(self, r):
+        self.emit("p = (p & 0x7D) | NZ[%s]" % r)
+        self.dirty.update((r, 'p'))
+
+    def push(self, value, nxt=None):
+        self.emit("ea = 0x100 | sp")
+        self.emit("sp = (sp - 1) & 0xFF")
+        self.dirty.add('sp')
+        self.write("ea", value, nxt)
+
+    def pull(self):
+        self.emit("sp = (sp + 1) & 0xFF")
+        self.dirty.add('sp')
+        return self.read_page(1, "0x100 | sp")
+
+    # instructions
+    # each one returns the pc of the next instruction of the path, or None
+    # if it ended the path
+
+    def op_LDA(self, op, name, mode, pc, nxt, lo, w):
+        self.cyc += self.cycletime[op]
+        r = name[2].lower()
+        self.emit("%s = %s" % (r, self.operand(op, mode, lo, w)))
+        self.flagsNZ(r)
+        return nxt
+
+    op_LDX = op_LDY = op_LDA
+
+    def op_STA(self, op, name, mode, pc, nxt, lo, w):
+        self.cyc += self.cycletime[op]
+        value = "0" if name == 'STZ' else name[2].lower()
+        self.write(self.address(op, mode, lo, w), value, nxt)
+        return nxt
+
+    op_STX = op_STY = op_STZ = op_STA
+
+    def op_ORA(self, op, name, mode, pc, nxt, lo, w):
+        self.cyc += self.cycletime[op]
+        sign = {'ORA': "|", 'AND': "&", 'EOR': "^"}[name]
+        self.emit("a %s= %s" % (sign, self.operand(op, mode, lo, w)))
+        self.flagsNZ('a')
+        return nxt
+
+    op_AND = op_EOR = op_ORA
+
+    def op_ADC(self, op, name, mode, pc, nxt, lo, w):
+        # decimal mode is left to py65
+        self.emit("if p & 0x08:")
+        self.indent += "    "
+        self.exit(pc, bail=True)
+        self.indent = self.indent[:-4]
+
+        self.cyc += self.cycletime[op]
+        v = self.operand(op, mode, lo, w)
+        if name == 'ADC':
+            self.emit("r = a + %s + (p & 1)" % v)
+            self.emit("p = (p & 0x3C) | NZ[r & 0xFF] | (r > 0xFF) | ((~(a ^ %s) & (a ^ r) & 0x80) >> 1)" % v)
+        else:
+            self.emit("r = a + (%s ^ 0xFF) + (p & 1)" % v)
+            self.emit("p = (p & 0x3C) | NZ[r & 0xFF] | (r > 0xFF) | (((a ^ %s) & (a ^ r) & 0x80) >> 1)" % v)
+        self.emit("a = r & 0xFF")
+        self.dirty.update(('a', 'p'))
+        return nxt
+
+    op_SBC = op_ADC
+
+    def op_CMP(self, op, name, mode, pc, nxt, lo, w):
+        self.cyc += self.cycletime[op]
+        r = {'CMP': 'a', 'CPX': 'x', 'CPY': 'y'}[name]
+        self.emit("r = %s - %s" % (r, self.operand(op, mode, lo, w)))
+        self.emit("p = (p & 0x7C) | NZ[r & 0xFF] | (r >= 0)")
+        self.dirty.add('p')
+        return nxt
+
+    op_CPX = op_CPY = op_CMP
+
+    def op_BIT(self, op, name, mode, pc, nxt, lo, w):
+        self.cyc += self.cycletime[op]
+        v = self.operand(op, mode, lo, w)
+        if mode == 'imm':
+            # only Z
+            self.emit("p = (p & 0xFD) | (0 if a & %s else 2)" % v)
+        else:
+            self.emit("p = (p & 0x3D) | (v & 0xC0) | (0 if a & v else 2)")
+        self.dirty.add('p')
+        return nxt
+
+    def op_ASL(self, op, name, mode, pc, nxt, lo, w):
+        # read-modify-write instructions
+        self.cyc += self.cycletime[op]
+        if mode == 'acc':
+            self.emit("v = a")
+        else:
+            addr = self.address(op, mode, lo, w)
+            self.emit("v = %s" % self.read(addr))
+
+        if name == 'ASL':
+            self.emit("r = (v << 1) & 0xFF")
+            self.emit("p = (p & 0x7C) | (v >> 7) | NZ[r]")
+        elif name == 'LSR':
+            self.emit("r = v >> 1")
+            self.emit("p = (p & 0x7C) | (v & 1) | NZ[r]")
+        elif name == 'ROL':
+            self.emit("r = ((v << 1) & 0xFF) | (p & 1)")
+            self.emit("p = (p & 0x7C) | (v >> 7) | NZ[r]")
+        elif name == 'ROR':
+            self.emit("r = (v >> 1) | ((p & 1) << 7)")
+            self.emit("p = (p & 0x7C) | (v & 1) | NZ[r]")
+        elif name == 'INC':
+            self.emit("r = (v + 1) & 0xFF")
+            self.emit("p = (p & 0x7D) | NZ[r]")
+        elif name == 'DEC':
+            self.emit("r = (v - 1) & 0xFF")
+            self.emit("p = (p & 0x7D) | NZ[r]")
+        elif name == 'TSB':
+            self.emit("r = v | a")
+            self.emit("p = (p & 0xFD) | (0 if v & a else 2)")
+        elif name == 'TRB':
+            self.emit("r = v & (a ^ 0xFF)")
+            self.emit("p = (p & 0xFD) | (0 if v & a else 2)")
+        elif name.startswith('RMB'):
+            self.emit("r = v & 0x%02X" % (0xFF ^ (1 << int(name[3]))))
+        elif name.startswith('SMB'):
+            self.emit("r = v | 0x%02X" % (1 << int(name[3])))
+
+        if name[:3] not in ('RMB', 'SMB'):
+            self.dirty.add('p')
+
+        if mode == 'acc':
+            self.emit("a = r")
+            self.dirty.add('a')
+        else:
+            self.write(addr, "r", nxt)
+        return nxt
+
+    op_LSR = op_ROL = op_ROR = op_INC = op_DEC = op_TSB = op_TRB = op_RMB = op_SMB = op_ASL
+
+    def op_INX(self, op, name, mode, pc, nxt, lo, w):
+        self.cyc += self.cycletime[op]
+        r = name[2].lower()
+        self.emit("%s = (%s %s 1) & 0xFF" % (r, r, "+" if name[0] == 'I' else "-"))
+        self.flagsNZ(r)
+        return nxt
+
+    op_INY = op_DEX = op_DEY = op_INX
+
+    def op_TAX(self, op, name, mode, pc, nxt, lo, w):
+        self.cyc += self.cycletime[op]
+        regs = {'A': 'a', 'X': 'x', 'Y': 'y', 'S': 'sp'}
+        src, dst = regs[name[1]], regs[name[2]]
+        self.emit("%s = %s" % (dst, src))
+        if dst == 'sp':
+            self.dirty.add(dst)
+        else:
+            self.flagsNZ(dst)
+        return nxt
+
+    op_TXA = op_TAY = op_TYA = op_TSX = op_TXS = op_TAX
+
+    def op_CLC(self, op, name, mode, pc, nxt, lo, w):
+        self.cyc += self.cycletime[op]
+        flag = {'C': 0x01, 'I': 0x04, 'D': 0x08, 'V': 0x40}[name[2]]
+        if name[0] == 'C':
+            self.emit("p &= 0x%02X" % (0xFF ^ flag))
+        else:
+            self.emit("p |= 0x%02X" % flag)
+        self.dirty.add('p')
+        return nxt
+
+    op_SEC = op_CLI = op_SEI = op_CLD = op_SED = op_CLV = op_CLC
+
+    def op_NOP(self, op, name, mode, pc, nxt, lo, w):
+        self.cyc += self.cycletime[op]
+        return nxt
+
+    def op_PHA(self, op, name, mode, pc, nxt, lo, w):
+        self.cyc += self.cycletime[op]
+        r = {'A': "a", 'X': "x", 'Y': "y", 'P': "p | 0x30"}[name[2]]
+        self.push(r, nxt)
+        return nxt
+
+    op_PHX = op_PHY = op_PHP = op_PHA
+
+    def op_PLA(self, op, name, mode, pc, nxt, lo, w):
+        self.cyc += self.cycletime[op]
+        v = self.pull()
+        if name == 'PLP':
+            self.emit("p = %s | 0x30" % v)
+            self.dirty.add('p')
+        else:
+            r = name[2].lower()
+            self.emit("%s = %s" % (r, v))
+            self.flagsNZ(r)
+        return nxt
+
+    op_PLX = op_PLY = op_PLP = op_PLA
+
+    def op_JMP(self, op, name, mode, pc, nxt, lo, w):
+        self.cyc += self.cycletime[op]
+        if mode == 'abs':
+            return w
+        if mode == 'ind':
+            self.exit("%s | %s << 8" % (self.read(w), self.read(w + 1)))
+        else:
+            self.emit("ea = (x + 0x%04X) & 0xFFFF" % w)
+            self.emit("t = (ea + 1) & 0xFFFF")
+            self.exit("%s | %s << 8" % (self.read("ea"), self.read("t")))
+        return None
+
+    def op_JSR(self, op, name, mode, pc, nxt, lo, w):
+        self.cyc += self.cycletime[op]
+        ret = (pc + 2) & 0xFFFF
+        self.push("0x%02X" % (ret >> 8))
+        self.push("0x%02X" % (ret & 0xFF), w)
+        return w
+
+    def op_RTS(self, op, name, mode, pc, nxt, lo, w):
+        self.cyc += self.cycletime[op]
+        self.emit("t = %s" % self.pull())
+        self.emit("t |= %s << 8" % self.pull())
+        self.exit("(t + 1) & 0xFFFF")
+        return None
+
+    def op_BRA(self, op, name, mode, pc, nxt, lo, w):
+        self.cyc += self.cycletime[op]
+        target = (nxt + lo - 0x100 if lo & 0x80 else nxt + lo) & 0xFFFF
+        taken = 1 + ((nxt ^ target) >> 8 != 0)
+
+        if name == 'BRA':
+            self.cyc += taken
+            return target
+
+        self.emit("if %s:" % BRANCHES[name])
+        state = (self.indent, self.cyc, set(self.dirty), set(self.visited))
+        self.indent += "    "
+        self.cyc += taken
+        self.path(target)
+        self.indent, self.cyc, self.dirty, self.visited = state
+        return nxt
+
+    op_BPL = op_BMI = op_BVC = op_BVS = op_BCC = op_BCS = op_BNE = op_BEQ = op_BRA
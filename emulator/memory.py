@@ -0,0 +1,140 @@
+# Copyright (C) 2021-2023 Alexandre Dumont <adumont@gmail.com>
+#
+# SPDX-License-Identifier: GPL-3.0-only
+
+# 64K memory for the emulated 6502, backed by a bytearray
+#
+# A drop-in replacement for py65's ObservableMemory (same subscribe_to_read/
+# subscribe_to_write API), but the subscriber lookup only happens for the
+# pages that have subscribers (the I/O pages: VRAM, getc/putc...). A 256
+# entries page table says which pages need dispatching, every other access
+# goes straight to the bytearray.
+#
+# A page can also be watched as a whole (watch_page): the JIT uses it to
+# hear about writes to pages holding translated code.
+
+class CerberusMemory:
+
+    def __init__(self, fill=0xEA):
+        self.data = bytearray([fill]) * 0x10000
+
+        # page --> dispatch function, or None for plain memory
+        self.read_pages = 256 * [None]
+        self.write_pages = 256 * [None]
+
+        # address --> list of callbacks
+        self._read_subscribers = {}
+        self._write_subscribers = {}
+
+        # page --> callback(address), see watch_page()
+        self._page_watchers = {}
+
+    def __len__(self):
+        return 0x10000
+
+    def __getitem__(self, address):
+        try:
+            handler = self.read_pages[address >> 8]
+        except (TypeError, IndexError):
+            # slice, or address out of the 16 bits range
+            if isinstance(address, slice):
+                return self.data[address]
+            return self[address & 0xFFFF]
+
+        if handler is None:
+            return self.data[address]
+        return handler(address)
+
+    def __setitem__(self, address, value):
+        try:
+            handler = self.write_pages[address >> 8]
+        except (TypeError, IndexError):
+            if isinstance(address, slice):
+                self._set_slice(address, value)
+            else:
+                self[address & 0xFFFF] = value
+            return
+
+        if handler is None:
+            self.data[address] = value
+        else:
+            handler(address, value)
+
+    def _set_slice(self, s, values):
+        r = range(*s.indices(0x10000))
+        values = bytes(values)
+        watched = any(self.write_pages[p] for p in {a >> 8 for a in r})
+
+        if watched or s.step not in (None, 1) or len(values) != len(r):
+            # some subscribers are watching this range (or it's not a plain
+            # copy): one byte at a time, like ObservableMemory
+            for a, v in zip(r, values):
+                self[a] = v
+        else:
+            self.data[r.start:r.stop] = values
+
+    def _dispatch_read(self, address):
+        result = None
+        for callback in self._read_subscribers.get(address, ()):
+            r = callback(address)
+            if r is not None:
+                result = r
+        if result is None:
+            return self.data[address]
+        return result
+
+    def _dispatch_write(self, address, value):
+        for callback in self._write_subscribers.get(address, ()):
+            r = callback(address, value)
+            if r is not None:
+                value = r
+        self.data[address] = value
+
+    def _dispatch_watched_write(self, address, value):
+        self._page_watchers[address >> 8](address)
+        if address in self._write_subscribers:
+            self._dispatch_write(address, value)
+        else:
+            self.data[address] = value
+
+    def subscribe_to_read(self, address_range, callback):
+        for address in address_range:
+            address &= 0xFFFF
+            callbacks = self._read_subscribers.setdefault(address, [])
+            if callback not in callbacks:
+                callbacks.append(callback)
+            self.read_pages[address >> 8] = self._dispatch_read
+
+    def subscribe_to_write(self, address_range, callback):
+        for address in address_range:
+            address &= 0xFFFF
+            callbacks = self._write_subscribers.setdefault(address, [])
+            if callback not in callbacks:
+                callbacks.append(callback)
+            if address >> 8 not in self._page_watchers:
+                self.write_pages[address >> 8] = self._dispatch_write
+
+    def watch_page(self, page, callback):
+        # callback(address) is called before every write to the page
+        # (one watcher per page)
+        self._page_watchers[page] = callback
+        self.write_pages[page] = self._dispatch_watched_write
+
+    def unwatch_page(self, page):
+        del self._page_watchers[page]
+        if any(a >> 8 == page for a in self._write_subscribers):
+            self.write_pages[page] = self._dispatch_write
+        else:
+            self.write_pages[page] = None
+
+    def write(self, start_address, bytes):
+        # raw write, subscribers are not called (same as ObservableMemory)
+        start_address &= 0xFFFF
+        self.data[start_address:start_address + len(bytes)] = bytes
+
+    def view(self, start=0, end=0x10000):
+        # zero-copy view into the memory
+        return memoryview(self.data)[start:end]
+
+    def snapshot(self):
+        return bytes(self.data)
@@ -0,0 +1,105 @@
+# Copyright (C) 2021-2023 Alexandre Dumont <adumont@gmail.com>
+#
+# SPDX-License-Identifier: GPL-3.0-only
+
+# Saved profiles, and the difference between two of them
+#
+# profiler.py -o FILE saves the flat profile as JSON:
+#
+#   { "version": 1, "rom": ..., "rom_sha1": ..., "processorCycles": N,
+#     "labels": { label: { "cycles": .., "instructions": .., "calls": .. } } }
+#
+# "calls" is the number of times the first instruction of the label ran
+# (the JSRs, JMPs and NEXT dispatches that land there, and the loops back to
+# it). Labels are matched by name, so profiles of two builds of the kernel
+# can be compared: "profiler.py diff OLD NEW" lists the labels whose cycles
+# changed the most, and exits with 1 if the total, or a single label, rose by
+# more than --threshold percent of the old total.
+
+import json
+import argparse
+import hashlib
+
+PROFILE_VERSION = 1
+
+def make_profile(stats, counts, symbols, cycles, rom=None):
+    # stats/counts: cycles and instructions run per address
+    labels = {}
+    for a in range(0x10000):
+        if counts[a]:
+            label = symbols.getGlobalSymbol(a) or "$%04X" % (a & 0xFF00)
+            entry = labels.get(label)
+            if entry is None:
+                start = symbols.addrs.get(label)
+                entry = labels[label] = { "cycles": 0, "instructions": 0,
+                    "calls": counts[start] if start is not None else 0 }
+            entry["cycles"] += stats[a]
+            entry["instructions"] += counts[a]
+
+    profile = { "version": PROFILE_VERSION, "processorCycles": cycles, "labels": labels }
+    if rom:
+        with open(rom, 'rb') as f:
+            profile["rom_sha1"] = hashlib.sha1(f.read()).hexdigest()
+        profile["rom"] = rom
+    return profile
+
+def save_profile(filename, profile):
+    with open(filename, "w") as f:
+        json.dump(profile, f, indent=1, sort_keys=True)
+        f.write("\n")
+
+def load_profile(filename):
+    with open(filename) as f:
+        profile = json.load(f)
+    if profile.get("version") != PROFILE_VERSION:
+        raise ValueError("%s: unsupported profile version %s" % (filename, profile.get("version")))
+    return profile
+
+def diff_profiles(old, new):
+    # [(label, old cycles, new cycles)], the biggest changes first
+    a = old["labels"]
+    b = new["labels"]
+    rows = []
+    for label in set(a) | set(b):
+        x = a.get(label, {}).get("cycles", 0)
+        y = b.get(label, {}).get("cycles", 0)
+        if x != y:
+            rows.append((label, x, y))
+    rows.sort(key=lambda r: (-abs(r[2] - r[1]), r[0]))
+    return rows
+
+def diff_main(argv):
+    # profiler.py diff OLD NEW: returns the exit code
+    parser = argparse.ArgumentParser(prog="profiler.py diff", description="compare two profiles saved with profiler.py -o")
+    parser.add_argument('old', help='profile of the reference build')
+    parser.add_argument('new', help='profile of the new build')
+    parser.add_argument('-n','--top', help='number of labels listed', type=int, default=30)
+    parser.add_argument('-t','--threshold', help='exit with 1 if the total or a label rose by more than PCT%% of the old total', type=float, default=None)
+    args = parser.parse_args(argv)
+
+    old = load_profile(args.old)
+    new = load_profile(args.new)
+
+    total_old = old["processorCycles"]
+    total_new = new["processorCycles"]
+    base = total_old or 1
+
+    def pct(delta):
+        return 100.0 * delta / base
+
+    print("%-20s %12s %12s %12s %8s" % ("label", "old", "new", "delta", "% total"))
+    rows = diff_profiles(old, new)
+    for label, x, y in rows[:args.top]:
+        print("%-20s %12d %12d %+12d %+7.2f%%" % (label, x, y, y - x, pct(y - x)))
+    print("%-20s %12d %12d %+12d %+7.2f%%" % ("processorCycles", total_old, total_new,
+        total_new - total_old, pct(total_new - total_old)))
+
+    if args.threshold is None:
+        return 0
+
+    regressions = [ r for r in rows if pct(r[2] - r[1]) > args.threshold ]
+    if pct(total_new - total_old) > args.threshold:
+        regressions.append(("processorCycles", total_old, total_new))
+    for label, x, y in regressions:
+        print("regression: %s %+d cycles (%+.2f%%)" % (label, y - x, pct(y - x)))
+    return 1 if regressions else 0
@@ -5,6 +5,7 @@
 # SPDX-License-Identifier: GPL-3.0-only
 
 import os
+import sys
 import time
 import locale
 
@@ -12,10 +13,21 @@ import argparse
 
 from py65.devices.mpu65c02 import MPU as CMOS65C02
 from py65.utils.conversions import itoa
-from py65.memory import ObservableMemory
 
 from collections import defaultdict
-from disass import decode
+from disass import format_instr
+from symtab import SymbolTable
+from memory import CerberusMemory
+from exectrace import TraceWriter
+from callgraph import CallGraph
+from sampler import Sampler
+from profdata import make_profile, save_profile, diff_main
+from heatmap import CountingMemory, Heatmap, HAVE_NUMPY
+from workload import Workload, marker
+
+# profiler.py diff OLD NEW (see profdata.py)
+if sys.argv[1:2] == ["diff"]:
+    sys.exit(diff_main(sys.argv[2:]))
 
 # Argument parsing
 parser = argparse.ArgumentParser()
@@ -23,9 +35,26 @@ parser.add_argument('-r','--rom', help='binary rom file', default="forth.bin")
 parser.add_argument('-a','--addr', help='address to load to', default=0xC000)
 parser.add_argument('-l','--logfile', help='filename of log', default=None)
 parser.add_argument('-s','--symbols', help='symbols file', default="forth.lbl")
-parser.add_argument('-t','--trace', help='trace file', default=None)
+parser.add_argument('-t','--trace', help='binary trace file (see tracedump.py)', default=None)
+parser.add_argument('--trace-ring', help='only keep the last N trace records (in memory)', type=int, default=None)
+parser.add_argument('-i','--input', help='keyboard input file (- for stdin), typed like in cerbemu (MAILBOX/NMI)', default=None)
+parser.add_argument('--start', help='only profile from this marker on: pc:LABEL, cycles:N, mem:LABEL==V or idle (see workload.py)', default=None)
+parser.add_argument('--stop', help='stop at this marker (can be repeated, the first one hit after the start wins; default: mem:BOOT==0, the end of the boot, or idle with --start: the input is all typed and run)', action='append', default=None)
+parser.add_argument('-p','--pcs', help='also list the N instructions that took the most cycles', type=int, default=0)
+parser.add_argument('-o','--output', help='save the profile (cycles, instructions and calls per label) to this JSON file, see "profiler.py diff"', default=None)
+parser.add_argument('-g','--callgraph', help='also follow JSR/RTS and Forth words, report inclusive/exclusive cycles (slower)', action='store_true')
+parser.add_argument('--collapsed', help='write the call stacks to this file, in collapsed format for flamegraph tools (implies -g, unless -S)', default=None)
+parser.add_argument('-S','--sample', help='sampling profile: only record PC, W and IP every N cycles (close to full speed)', type=int, default=None)
+parser.add_argument('--heatmap', help='count memory reads/writes and opcodes (needs NumPy), save them as PREFIX-*.npy/.pgm', metavar='PREFIX', default=None)
+parser.add_argument('--top', help='number of words/routines listed by -g, -S or --heatmap', type=int, default=20)
 args = parser.parse_args()
 
+if args.heatmap and not HAVE_NUMPY:
+    parser.error("--heatmap needs NumPy (pip install numpy)")
+
+if args.sample and (args.trace or args.callgraph or args.output):
+    parser.error("-S/--sample can't be used with --trace, -g or -o")
+
 locale.setlocale(locale.LC_ALL, '')
 code = locale.getpreferredencoding()
 
@@ -40,35 +69,19 @@ def getWord(address):
 
 symbols = None
 
-def parseSymbolsFile(filename):
-    symbols = {}
-    with open(filename) as file:
-        for line in file:
-            _, a, s = line.split(" ")
-            if s.startswith(".__word_") or s.startswith(".h_"):
-                # we discard those symbols
-                continue
-            symbols[int(a,16)]=s.strip()[1:]
-    return symbols
-
 def getSymbol(addr):
-    l = symbols[max(k for k in symbols if (k <= addr and not symbols[k]. startswith("@")))]
-    sl  = symbols[max(k for k in symbols if k <= addr)]
+    l = symbols.getGlobalSymbol(addr)
+    sl  = symbols.getSymbol(addr)
     if sl == l:
         sl=""
     return l,sl
 
 def getLabelAddr(label):
-    return [ k for k in symbols if symbols[k] == label ][0]
+    return symbols.getLabelAddr(label)
 
 mpu = CMOS65C02()
-mpu.memory = 0x10000 * [0xEA]
-mpu.memory[0xF800:0xFCAF] =  (0xFCAF-0xF800+1)* [0x20]
-
-addrWidth = mpu.ADDR_WIDTH
-
-m = ObservableMemory(subject=mpu.memory, addrWidth=addrWidth)
-mpu.memory = m
+mpu.memory = CountingMemory() if args.heatmap else CerberusMemory()
+mpu.memory.data[0xF800:0xFCB0] = (0xFCAF-0xF800+1) * b"\x20"
 
 if args.addr and str(args.addr).startswith("0x"):
     args.addr = int(args.addr,16)
@@ -82,7 +95,7 @@ else:
     program = [ 0xA9, 97, 0x8D, 0x01, 0xF0 ]
 
 if args.symbols:
-    symbols=parseSymbolsFile(args.symbols)
+    symbols=SymbolTable.load(args.symbols)
 
 load(mpu.memory, args.addr, program)
 
@@ -94,43 +107,116 @@ mpu.memory[0xFFFD] = ( args.addr >> 8 ) & 0xFF
 # Reset: RESET vector => PC
 mpu.pc=getWord(mpu.RESET)
 
-stats=0x10000 * [0]
-
-last_processorCycles = 0
-last_pc=0
-
-addr_BOOT = getLabelAddr("BOOT")
-
-if args.trace:
-    file = open("/tmp/stats", "w")
-
-while True:
-    # print("%04X %04X %d" % (mpu.pc, last_pc, mpu.processorCycles-last_processorCycles))
-    # input("key")
-    stats[last_pc] += mpu.processorCycles-last_processorCycles
-
-    opcode, mode, _ = decode(getByte(last_pc))
-
-    label, sublabel=getSymbol(last_pc)
-
-    c = '.' if mpu.a < 32 or mpu.a > 126 else mpu.a
-
-    if args.trace:
-        file.write("%d %04X %s %02X %c %02X %02X %d %s %s\n" % ( mpu.processorCycles, last_pc, opcode, mpu.a, c, mpu.x, mpu.y, mpu.processorCycles-last_processorCycles, label, sublabel ) )
+keys = b""
+if args.input == "-":
+    keys = sys.stdin.buffer.read()
+elif args.input:
+    with open(args.input, 'rb') as f:
+        keys = f.read()
+
+try:
+    start = marker(args.start, mpu, symbols) if args.start else None
+    # with --start the boot may be over already: the default is the end of
+    # the input instead
+    default = [ "idle" if args.start else "mem:BOOT==0" ]
+    stops = [ marker(m, mpu, symbols) for m in args.stop or default ]
+except ValueError as e:
+    parser.error(e)
+
+workload = Workload(mpu, keys, start, stops)
+
+# not profiled: up to the start marker
+workload.run_to_start()
+
+start_cycles = mpu.processorCycles
+
+tracer = TraceWriter(args.trace, mpu, args.trace_ring) if args.trace else None
+
+# wraps mpu.step, before the run loops take it
+heatmap = Heatmap(mpu) if args.heatmap else None
+
+def profile(mpu, done, tracer=None):
+    # Runs until done() (stop marker hit, it also types the keys). The hot
+    # loop only adds the cycles of each instruction to the counter of its
+    # address, and counts it: decoding and symbols are left for after the
+    # run. Returns the cycles and instructions counters.
+    stats = 0x10000 * [0]
+    counts = 0x10000 * [0]
+    step = mpu.step
+    cycles = mpu.processorCycles
+
+    if tracer:
+        record = tracer.record
+        while True:
+            pc = mpu.pc
+            record(mpu)
+            step()
+            now = mpu.processorCycles
+            stats[pc] += now - cycles
+            counts[pc] += 1
+            cycles = now
+            if done():
+                break
+    else:
+        while True:
+            pc = mpu.pc
+            step()
+            now = mpu.processorCycles
+            stats[pc] += now - cycles
+            counts[pc] += 1
+            cycles = now
+            if done():
+                break
+
+    return stats, counts
+
+def sample(mpu, sampler, done):
+    # Sampling run: the loop only compares the clock with the next sample
+    step = mpu.step
+    while True:
+        step()
+        if mpu.processorCycles >= sampler.next:
+            sampler.sample()
+        if done():
+            break
+
+graph = None
+sampler = None
+
+if args.sample:
+    sampler = Sampler(mpu, symbols, args.sample)
+    sample(mpu, sampler, workload.done)
+elif args.callgraph or args.collapsed:
+    graph = CallGraph(mpu, symbols)
+    stats = 0x10000 * [0]
+    counts = 0x10000 * [0]
+    graph.run(workload.done, stats, tracer, counts)
+else:
+    stats, counts = profile(mpu, workload.done, tracer)
 
-    last_processorCycles = mpu.processorCycles
-    last_pc = mpu.pc
+if tracer:
+    tracer.close()
 
-    mpu.step()
+cycles = mpu.processorCycles - start_cycles
+print("processorCycles:", cycles)
 
-    if mpu.memory[addr_BOOT] == 0:
-        break
+if heatmap:
+    print(heatmap.report(symbols, args.top))
+    print()
+    heatmap.save(args.heatmap)
 
-if args.trace:
-    file.close()
+if sampler:
+    print(sampler.report(args.top))
+    if args.collapsed:
+        with open(args.collapsed, "w") as f:
+            for line in sampler.collapsed():
+                f.write(line + "\n")
+    quit()
 
-print("processorCycles:", mpu.processorCycles)
+if args.output:
+    save_profile(args.output, make_profile(stats, counts, symbols, cycles, args.rom))
 
+# per label totals, symbols are looked up once per address executed
 label_stats = defaultdict(int)
 
 for a in range(0x10000):
@@ -142,4 +228,20 @@ for a in range(0x10000):
         label_stats[label]+=stats[a]
 
 for a in sorted(label_stats, key=label_stats.get, reverse=True):
-    print("%s %d" % ( a, label_stats[a] ))
\ No newline at end of file
+    print("%s %d" % ( a, label_stats[a] ))
+
+if args.pcs:
+    print()
+    total = cycles or 1
+    for a in sorted((a for a in range(0x10000) if stats[a]), key=stats.__getitem__, reverse=True)[:args.pcs]:
+        instr = format_instr(a, getByte(a), getByte(a+1), getByte(a+2))
+        print("%6.2f%% %10d  %s%s" % (100.0 * stats[a] / total, stats[a], instr, symbols.getSymbol(a) or ""))
+
+if graph:
+    print()
+    print(graph.report(args.top))
+
+    if args.collapsed:
+        with open(args.collapsed, "w") as f:
+            for line in graph.collapsed():
+                f.write(line + "\n")
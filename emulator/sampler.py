@@ -0,0 +1,96 @@
+# Copyright (C) 2021-2023 Alexandre Dumont <adumont@gmail.com>
+#
+# SPDX-License-Identifier: GPL-3.0-only
+
+# Sampling profiler, driven by the emulated clock
+#
+# Every N clock cycles (mpu.processorCycles, not the host clock, so two runs
+# of the same session give the same samples) we record the PC and the Forth
+# context: W (the word being executed) and IP (inside the colon definition
+# that called it). The run loop only compares the cycle counter with
+# sampler.next, like the throttle does:
+#
+#     if sampler and mpu.processorCycles >= sampler.next:
+#         sampler.sample()
+#
+# The sample is taken at the first instruction boundary after each period
+# (with --jit, the first block boundary). Names are resolved after the run:
+# PC --> label, W --> word, IP --> the word whose code field is the closest
+# below (the colon definition being run).
+
+from bisect import bisect_right
+from collections import Counter
+
+from dictindex import DictionaryIndex
+
+W  = 0xFE
+IP = 0xFC
+
+class Sampler:
+
+    def __init__(self, mpu, symbols, every):
+        self.mpu = mpu
+        self.symbols = symbols
+        self.every = every
+        self.addr_LATEST = symbols.addrs.get("LATEST")
+
+        self.samples = Counter()  # (pc, W, IP) --> count
+        self.next = mpu.processorCycles + every
+
+    def sample(self):
+        mpu = self.mpu
+        data = mpu.memory.data
+        self.samples[mpu.pc, data[W] + 256*data[W+1], data[IP] + 256*data[IP+1]] += 1
+        # skip the periods an instruction (or a JIT block) ran past
+        self.next += self.every * ((mpu.processorCycles - self.next) // self.every + 1)
+
+    def _resolver(self):
+        # (label of pc, word of W, colon definition of IP)
+        words = {}
+        if self.addr_LATEST is not None:
+            words = DictionaryIndex(self.mpu.memory, self.addr_LATEST).words()
+        cfas = sorted(words)
+        symbols = self.symbols
+
+        def label(addr):
+            return symbols.getGlobalSymbol(addr) or "$%04X" % addr
+
+        def word(cfa):
+            return words.get(cfa) or symbols.symbols.get(cfa) or "$%04X" % cfa
+
+        def caller(ip):
+            i = bisect_right(cfas, ip)
+            return words[cfas[i-1]] if i else "$%04X" % ip
+
+        return label, word, caller
+
+    def totals(self):
+        # Counters of samples per label, per word and per caller
+        label, word, caller = self._resolver()
+        labels, words, callers = Counter(), Counter(), Counter()
+        for (pc, w, ip), n in self.samples.items():
+            labels[label(pc)] += n
+            words[word(w)] += n
+            callers[caller(ip)] += n
+        return labels, words, callers
+
+    def report(self, top=20):
+        labels, words, callers = self.totals()
+        total = sum(self.samples.values()) or 1
+        lines = [ "%d samples, every %d cycles" % (sum(self.samples.values()), self.every) ]
+        for title, counter in (("label", labels), ("word (W)", words), ("caller (IP)", callers)):
+            lines.append("")
+            lines.append("%-16s %8s" % (title, "samples"))
+            for name, n in counter.most_common(top):
+                lines.append("%-16s %8d %6.2f%%" % (name, n, 100.0 * n / total))
+        return "\n".join(lines)
+
+    def collapsed(self):
+        # "caller;word;label cycles" lines for flamegraph tools, each sample
+        # weighing the sampling period
+        label, word, caller = self._resolver()
+        stacks = Counter()
+        for (pc, w, ip), n in self.samples.items():
+            frames = [ caller(ip), word(w), label(pc) ]
+            stacks[";".join(f.replace(";", ":") for f in frames)] += n * self.every
+        return sorted("%s %d" % item for item in stacks.items())
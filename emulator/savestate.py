@@ -0,0 +1,102 @@
+# Copyright (C) 2021-2023 Alexandre Dumont <adumont@gmail.com>
+#
+# SPDX-License-Identifier: GPL-3.0-only
+
+# Save states: snapshot and restore the whole machine
+#
+# File layout (little endian):
+#
+#   0  magic "CERBSTAT"
+#   8  version (u16)
+#  10  PC (u16)
+#  12  A, X, Y, SP, P (u8 each)
+#  17  padding
+#  24  processorCycles (u64)
+#  32  length of the pending keyboard queue (u32)
+#  36  padding up to HEADER_SIZE
+#  64  64K memory image
+#  64+64K pending keys
+#
+# The memory image is at a fixed offset, so on load we mmap the file and
+# copy it straight into the emulator memory. A state can also be saved
+# gzip compressed (compress=True, for xcompiler's checkpoints): load_state()
+# recognizes those and decompresses them instead.
+#
+# There's no separate NMI state to save: a key being delivered lives in
+# MAILFLAG/MAILBOX (memory) and the I flag (P register).
+
+import gzip
+import mmap
+import struct
+
+MAGIC = b"CERBSTAT"
+VERSION = 1
+
+HEADER = struct.Struct("<8sHHBBBBB7xQI")
+HEADER_SIZE = 64
+MEM_SIZE = 0x10000
+
+GZIP_MAGIC = b"\x1f\x8b"
+
+def save_state(filename, mpu, keys=b"", compress=False):
+    keys = bytes(keys)
+    header = HEADER.pack(MAGIC, VERSION, mpu.pc, mpu.a, mpu.x, mpu.y, mpu.sp, mpu.p,
+                         mpu.processorCycles, len(keys))
+
+    memory = mpu.memory
+    if hasattr(memory, "snapshot"):
+        image = memory.snapshot()
+    else:
+        image = bytes(memory[0:MEM_SIZE])
+
+    opener = (lambda name, mode: gzip.open(name, mode, compresslevel=1)) if compress else open
+    with opener(filename, 'wb') as f:
+        f.write(header.ljust(HEADER_SIZE, b"\0"))
+        f.write(image)
+        f.write(keys)
+
+def load_state(filename, mpu):
+    # restores memory, registers and cycles counter into mpu.
+    # returns the pending keys (bytes)
+    with open(filename, 'rb') as f:
+        if f.read(2) == GZIP_MAGIC:
+            f.seek(0)
+            with gzip.open(f) as gz:
+                return _restore(filename, gz.read(), mpu)
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            return _restore(filename, mm, mpu)
+
+def _restore(filename, buf, mpu):
+    if len(buf) < HEADER_SIZE:
+        raise ValueError("%s: not a save state file" % filename)
+    magic, version, pc, a, x, y, sp, p, cycles, nkeys = HEADER.unpack_from(buf, 0)
+
+    if magic != MAGIC:
+        raise ValueError("%s: not a save state file" % filename)
+    if version != VERSION:
+        raise ValueError("%s: unsupported save state version %d" % (filename, version))
+    # checked before touching the memory: a short image would shrink it
+    if len(buf) < HEADER_SIZE + MEM_SIZE + nkeys:
+        raise ValueError("%s: truncated save state (%d bytes, %d expected)" % (
+            filename, len(buf), HEADER_SIZE + MEM_SIZE + nkeys))
+
+    image = memoryview(buf)[HEADER_SIZE:HEADER_SIZE+MEM_SIZE]
+    if hasattr(mpu.memory, "data"):
+        # raw copy, I/O subscribers aren't called
+        mpu.memory.data[:] = image
+    else:
+        mpu.memory[0:MEM_SIZE] = image
+    image.release()
+
+    start = HEADER_SIZE+MEM_SIZE
+    keys = buf[start:start+nkeys]
+
+    mpu.pc = pc
+    mpu.a = a
+    mpu.x = x
+    mpu.y = y
+    mpu.sp = sp
+    mpu.p = p
+    mpu.processorCycles = cycles
+
+    return keys
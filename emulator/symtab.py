@@ -0,0 +1,96 @@
+# Copyright (C) 2021-2023 Alexandre Dumont <adumont@gmail.com>
+#
+# SPDX-License-Identifier: GPL-3.0-only
+
+# Symbol table shared by cerbemu, profiler and xcompiler
+#
+# The .lbl file (generated by cl65 -Ln) is parsed once, and we precompute
+# two 64K arrays (address --> nearest label at or below that address), so
+# resolving an address is a single list index, and a name --> address dict.
+# The result is cached next to the .lbl file (foo.lbl --> foo.lbl.cache).
+
+import os
+import pickle
+
+CACHE_VERSION = 1
+
+def parseSymbolsFile(filename):
+    # file content should look like this:
+    # al 00C23D .do_PUSH1
+    # al 00C239 .__word_12
+    # al 00C239 .h_PUSH1
+    # al 00C22E .__word_11
+    symbols = {}
+    with open(filename) as file:
+        for line in file:
+            _, a, s = line.split(" ")
+            if s.startswith(".__word_") or s.startswith(".h_"):
+                # we discard those symbols
+                continue
+            symbols[int(a,16)]=s.strip()[1:]
+    return symbols
+
+class SymbolTable:
+
+    def __init__(self, symbols):
+        self.symbols = symbols   # addr --> label
+
+        # label --> addr (first one wins, like the old linear search)
+        self.addrs = {}
+        for a, s in symbols.items():
+            self.addrs.setdefault(s, a)
+
+        # addr --> nearest label, and nearest label that is not a
+        # cheap local label (@xxx)
+        self.labels = 0x10000 * [None]
+        self.global_labels = 0x10000 * [None]
+
+        label = None
+        global_label = None
+        for a in range(0x10000):
+            s = symbols.get(a)
+            if s is not None:
+                label = s
+                if not s.startswith("@"):
+                    global_label = s
+            self.labels[a] = label
+            self.global_labels[a] = global_label
+
+    def __len__(self):
+        return len(self.symbols)
+
+    def getSymbol(self, addr):
+        return self.labels[addr & 0xFFFF]
+
+    def getGlobalSymbol(self, addr):
+        return self.global_labels[addr & 0xFFFF]
+
+    def getLabelAddr(self, label):
+        return self.addrs[label]
+
+    @classmethod
+    def load(cls, filename):
+        # returns the table for filename, from the cache if it is up to date
+        st = os.stat(filename)
+        key = (CACHE_VERSION, st.st_mtime_ns, st.st_size)
+        cache = filename + ".cache"
+
+        try:
+            with open(cache, 'rb') as f:
+                cached_key, table = pickle.load(f)
+            if cached_key == key:
+                return table
+        except (OSError, EOFError, pickle.UnpicklingError, ValueError, AttributeError):
+            pass
+
+        table = cls(parseSymbolsFile(filename))
+
+        try:
+            tmp = cache + ".%d" % os.getpid()
+            with open(tmp, 'wb') as f:
+                pickle.dump((key, table), f, pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, cache)
+        except OSError:
+            pass # read-only dir? we'll parse again next time
+
+        return table
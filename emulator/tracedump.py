@@ -0,0 +1,42 @@
+#!/usr/bin/env python3
+
+# Copyright (C) 2021-2023 Alexandre Dumont <adumont@gmail.com>
+#
+# SPDX-License-Identifier: GPL-3.0-only
+
+# Decodes a binary trace (written by cerbemu.py or profiler.py with --trace)
+# into a symbolized, disassembled text listing
+
+import sys
+import signal
+import argparse
+
+from py65.utils.conversions import itoa
+
+from disass import format_instr
+from symtab import SymbolTable
+from exectrace import read_trace
+
+parser = argparse.ArgumentParser()
+parser.add_argument('trace', help='binary trace file')
+parser.add_argument('-s','--symbols', help='symbols file', default=None)
+parser.add_argument('-n','--limit', help='decode only the first N records', type=int, default=None)
+args = parser.parse_args()
+
+# don't choke when piped into head/less
+signal.signal(signal.SIGPIPE, signal.SIG_DFL)
+
+symbols = SymbolTable.load(args.symbols) if args.symbols else None
+
+out = sys.stdout
+
+for n, (cycles, pc, instr, a, x, y, s, p, w, ip) in enumerate(read_trace(args.trace)):
+    if args.limit is not None and n >= args.limit:
+        break
+
+    curr_instr = format_instr(pc, *instr)
+    if symbols:
+        curr_instr += symbols.getSymbol(pc) or ""
+
+    out.write("%10d | A:%02X  X:%02X  Y:%02X  S:%02X  P:%s |  W: %04X  IP: %04X | %s\n" % (
+        cycles, a, x, y, s, itoa(p, 2).rjust(8, '0'), w, ip, curr_instr ) )
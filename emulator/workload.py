@@ -0,0 +1,121 @@
+# Copyright (C) 2021-2023 Alexandre Dumont <adumont@gmail.com>
+#
+# SPDX-License-Identifier: GPL-3.0-only
+
+# Keyboard input and start/stop markers, for runs that aren't just the boot
+#
+# Keys are delivered the way CAT does (send_key): the key in MAILBOX, 1 in
+# MAILFLAG, then a NMI. The kernel's NMI handler clears MAILFLAG once it has
+# taken the key, and then the next key is sent.
+#
+# Markers say where a region of interest starts or ends:
+#
+#   pc:LABEL  pc:$C123       the PC reaches it (before it runs)
+#   cycles:N                 N clock cycles since reset
+#   mem:LABEL==V  mem:$0205!=0   a byte of memory is (or isn't) V
+#   idle                     the kernel waits in getc and there's no key left
+#                            to type (keys are sent as soon as MAILFLAG is 0)
+#
+# The stop markers are only looked at once the start marker is hit.
+
+MAILFLAG = 0x0200
+MAILBOX  = 0x0201
+
+def nmi(mpu):
+    # triggers a NMI IRQ in the processor
+    # this is very similar to the BRK instruction
+    mpu.stPushWord(mpu.pc)
+    mpu.p &= ~mpu.BREAK
+    mpu.stPush(mpu.p | mpu.UNUSED)
+    mpu.p |= mpu.INTERRUPT
+    mpu.pc = mpu.WordAt(mpu.NMI)
+    mpu.processorCycles += 7
+
+def send_key(mpu, key):
+    # deliver a key the way CAT does: MAILBOX/MAILFLAG, then NMI
+    mpu.memory[MAILFLAG]=1
+    mpu.memory[MAILBOX]=key
+    nmi(mpu)
+
+def parse_address(text, symbols):
+    # $C000, 0xC000 or a label
+    try:
+        if text.startswith("$"):
+            return int(text[1:], 16)
+        if text.startswith("0x"):
+            return int(text, 16)
+        return symbols.getLabelAddr(text)
+    except (KeyError, ValueError, AttributeError):
+        raise ValueError("unknown address %s" % text)
+
+def marker(spec, mpu, symbols):
+    # returns a function telling whether the marker is hit
+    kind, _, arg = spec.partition(":")
+
+    if kind == "pc":
+        address = parse_address(arg, symbols)
+        return lambda: mpu.pc == address
+
+    if kind == "cycles":
+        cycles = int(arg, 0)
+        return lambda: mpu.processorCycles >= cycles
+
+    if kind == "idle" and not arg:
+        try:
+            address = parse_address("getc", symbols)
+        except ValueError:
+            raise ValueError("the idle marker needs the getc label")
+        data = mpu.memory.data
+        return lambda: mpu.pc == address and data[MAILFLAG] == 0
+
+    if kind == "mem":
+        data = mpu.memory.data
+        for op in ("==", "!="):
+            if op in arg:
+                where, value = arg.split(op)
+                address = parse_address(where, symbols)
+                value = int(value, 0)
+                if op == "==":
+                    return lambda: data[address] == value
+                return lambda: data[address] != value
+
+    raise ValueError("bad marker %s (pc:LABEL, cycles:N, mem:LABEL==V or idle)" % spec)
+
+class Workload:
+
+    def __init__(self, mpu, keys=b"", start=None, stops=()):
+        # start: a marker (None: right away), stops: markers, the first hit
+        # ends the run
+        self.mpu = mpu
+        self.data = mpu.memory.data
+        self.keys = list(keys)
+        self.keys.reverse() # so we can pop() them in order
+        self.start = start
+        self.stops = list(stops)
+
+    def feed(self):
+        # next key, if the kernel has consumed the previous one
+        if self.keys and self.data[MAILFLAG] == 0:
+            send_key(self.mpu, self.keys.pop())
+
+    def stopped(self):
+        for stop in self.stops:
+            if stop():
+                return True
+        return False
+
+    def done(self):
+        # called after each instruction of the run
+        self.feed()
+        return self.stopped()
+
+    def run_to_start(self):
+        # runs (not profiled) up to the start marker, typing the keys; the
+        # stop markers aren't looked at yet (mem:BOOT==0 could already be
+        # true when the region starts)
+        if self.start is None:
+            return
+        mpu = self.mpu
+        while not self.start():
+            mpu.step()
+            self.feed()
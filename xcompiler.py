@@ -4,26 +4,47 @@
 #
 # SPDX-License-Identifier: GPL-3.0-only
 
+import os
 import sys
 import argparse
+import io
+import json
 import time
+import hashlib
+import shutil
 import threading
+import contextlib
+from concurrent.futures import ProcessPoolExecutor
 from queue import Queue, Empty
 import signal
 
 from py65.devices.mpu65c02 import MPU as CMOS65C02
-from py65.memory import ObservableMemory
 from py65.utils import console
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "emulator"))
+from symtab import SymbolTable
+from memory import CerberusMemory
+from jit import BlockCache
+from dictindex import DictionaryIndex
+from savestate import save_state, load_state
+from hle import HLE, OffloadMismatch
+
 # Argument parsing
 parser = argparse.ArgumentParser()
 parser.add_argument('-r','--rom', help='binary rom file', default="forth.bin")
 parser.add_argument('-a','--addr', help='address to load to', default=0x8000)
 parser.add_argument('-l','--load', help='forth program to load')
-parser.add_argument('-t','--target', help='emu|hw', required=True)
+parser.add_argument('-t','--target', help='emu|hw')
 parser.add_argument('-f','--dfo', help='disable FIND offloading', default=False, action='store_true')
 parser.add_argument('-s','--symbols', help='symbols file', default="forth.lbl")
-args = parser.parse_args()
+parser.add_argument('--jit', help='translate hot code blocks to Python', default=False, action='store_true')
+parser.add_argument('--threaded', help='legacy mode: run the CPU in a thread, typing the input through a queue (echoed)', default=False, action='store_true')
+parser.add_argument('-c','--cache', help='directory for the checkpoints of incremental compilations (not with --threaded)', default=None)
+parser.add_argument('-o','--offload', help='run the input parsing primitives (WORD, PARSE, NUMBER) in Python', default=False, action='store_true')
+parser.add_argument('--verify-offload', help='like --offload, but also run them on the 6502 and stop if the results differ', default=False, action='store_true')
+parser.add_argument('--costs', help='report the cost of each definition compiled (and write it to costs-<target>.json); compiles from the start, checkpoints are not resumed', default=False, action='store_true')
+parser.add_argument('--force', help='compile even if the manifest says the outputs are up to date', default=False, action='store_true')
+parser.add_argument('-j','--job', help='compile for several targets at once, each in its own process (replaces -r/-s/-t, repeatable)', metavar='ROM:SYMBOLS:TARGET', action='append', default=[])
 
 getc_addr=0xF004
 putc_addr=0xF001
@@ -37,14 +58,9 @@ class ClearableQueue(Queue):
         except Empty:
             pass
 
-queue = ClearableQueue()
-emu_queue = Queue() # CPU --> Emulator
-
 def signal_handler(signum, frame):
     exit()
 
-signal.signal(signal.SIGINT, signal_handler)
-
 # CPU_EXIT_SIGNALS
 CPU_EXIT_OK = 0
 CPU_EXIT_ERROR = 1
@@ -52,76 +68,234 @@ CPU_EXIT_ERROR = 1
 symbols = None
 last_lookedup_word = ""
 
-def parseSymbolsFile(filename):
-    # file content should look like this:
-    # al 00C23D .do_PUSH1
-    # al 00C239 .__word_12
-    # al 00C239 .h_PUSH1
-    # al 00C22E .__word_11
-    symbols = {}
-    with open(filename) as file:
-        for line in file:
-            _, a, s = line.split(" ")
-            if s.startswith(".__word_") or s.startswith(".h_"):
-                # we discard those symbols
+addr_IP = 0xFE-2
+
+# primitives offloaded with --offload (see emulator/hle.py)
+PARSING_OFFLOADS = ["WORD", "PARSE", "NUMBER"]
+addr_DP = 0xFE-8
+
+def load_symbols(filename):
+    global symbols, getSymbol, getLabelAddr
+    global addr_NEXT, addr_LATEST, addr_do_FIND, addr_do_0BR, addr_numberError, addr_MODE
+
+    symbols=SymbolTable.load(filename)
+    getSymbol = symbols.getSymbol
+    getLabelAddr = symbols.getLabelAddr
+
+    # Address of symbols
+    addr_NEXT = getLabelAddr("NEXT")
+    addr_LATEST = getLabelAddr("LATEST")
+    addr_do_FIND = getLabelAddr("do_FIND")
+    addr_do_0BR = getLabelAddr("do_0BR")
+    addr_numberError = getLabelAddr("numberError")
+    addr_MODE = symbols.addrs.get("MODE")
+
+# bump when a change in xcompiler changes the state a compilation leaves
+CHECKPOINT_VERSION = 1
+
+class Checkpoints:
+    # Machine state checkpoints, for incremental compilations.
+    #
+    # Once the CPU has read the first n bytes of the input, the state of the
+    # machine only depends on the ROM (and our hooks) and on those n bytes.
+    # After each top-level definition (a newline read in execute MODE, LATEST
+    # changed) we save the machine (see savestate.py, compressed) in
+    #   <cache>/<target>-<hash of ROM, symbols & options>/<n>-<hash of the n bytes>.sav
+    # and the next run resumes from the longest one that still matches the
+    # input. The ones that don't are deleted, and so are the directories of
+    # the target's previous ROMs/symbols once it has a new key.
+
+    def __init__(self, directory, target, key, program):
+        self.cache = directory
+        self.target = target
+        self.directory = os.path.join(directory, "%s-%s" % (target, key))
+        self.program = program
+        self.offsets = set()    # checkpoints on disk
+        self.latest = None      # LATEST at the last checkpoint
+        self.saved = 0
+
+    def prefix_hash(self, n):
+        return hashlib.sha1(self.program[:n]).hexdigest()
+
+    def filename(self, n):
+        return os.path.join(self.directory, "%08d-%s.sav" % (n, self.prefix_hash(n)))
+
+    def prune(self):
+        # removes the checkpoints of the target's other keys
+        try:
+            names = os.listdir(self.cache)
+        except FileNotFoundError:
+            return
+        mine = os.path.basename(self.directory)
+        for name in names:
+            if name != mine and name.startswith(self.target + "-"):
+                shutil.rmtree(os.path.join(self.cache, name), ignore_errors=True)
+
+    def resume(self, mpu, load=True):
+        # loads the longest matching checkpoint into mpu, and returns the
+        # offset of the input to go on from (0 if none, or not load: the
+        # stale checkpoints are still cleaned up)
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            names = []
+            self.prune() # a new key
+
+        for name in names:
+            n, _, digest = name[:-len(".sav")].partition("-")
+            if not name.endswith(".sav") or not n.isdigit() or int(n) > len(self.program) or digest != self.prefix_hash(int(n)):
+                # stale, or a .tmp left by an interrupted save
+                os.remove(os.path.join(self.directory, name))
                 continue
-            symbols[int(a,16)]=s.strip()[1:]
-    return symbols
+            self.offsets.add(int(n))
+
+        offset = max(self.offsets, default=0) if load else 0
+        if offset:
+            load_state(self.filename(offset), mpu)
+            print("Resuming from checkpoint at input offset %d (%d bytes left)" % (offset, len(self.program) - offset))
+        self.latest = mpu.memory[addr_LATEST:addr_LATEST+2]
+        return offset
+
+    def update(self, mpu, offset):
+        # called after a newline was read
+        latest = mpu.memory[addr_LATEST:addr_LATEST+2]
+        if not mpu.memory[addr_MODE] or latest == self.latest:
+            return # compiling, or no new definition
+        self.latest = latest
+        if offset in self.offsets:
+            return
 
-def getSymbol(addr):
-    return symbols[max(k for k in symbols if k <= addr)]
+        os.makedirs(self.directory, exist_ok=True)
+        filename = self.filename(offset)
+        tmp = "%s.%d.tmp" % (filename, os.getpid())
+        save_state(tmp, mpu, compress=True)
+        os.replace(tmp, filename)
+        self.offsets.add(offset)
+        self.saved += 1
+
+class CostReport:
+    # Cost of each definition compiled: emulated cycles, host time and
+    # dictionary bytes.
+    #
+    # LATEST is looked at each time the CPU reads a byte of input. When it
+    # has changed, a header was just created: what happens from there to the
+    # next one (compiling the body, running top-level code, reading the next
+    # name...) is charged to that definition. FIND being offloaded, its
+    # cycles aren't counted.
+
+    TOP = 20 # lines in the table
+
+    def __init__(self, mpu, program):
+        self.mpu = mpu
+        self.program = program
+        self.records = []
+        self.current = None
+        self.latest = None
+        self.start = time.perf_counter()
+
+    def getWord(self, address):
+        return self.mpu.memory[address] + 256*self.mpu.memory[address+1]
+
+    def close(self):
+        # ends the current record
+        r = self.current
+        if r:
+            r["cycles"] = self.mpu.processorCycles - r["cycles"]
+            r["seconds"] = round(time.perf_counter() - r["seconds"], 6)
+            end = r.pop("end")
+            r["bytes"] = end - r["header"] if r["header"] else 0
+            self.records.append(r)
+        self.current = None
+
+    def on_read(self, pos):
+        mem = self.mpu.memory
+        latest = self.getWord(addr_LATEST)
+        dp = self.getWord(addr_DP)
+
+        r = self.current
+        if r and latest == self.latest:
+            # the dictionary can switch between ROM and RAM (>ROM, >RAM):
+            # only count how far HERE went after the header
+            if r["header"] <= dp < r["header"] + 0x4000:
+                r["end"] = max(r["end"], dp)
+            return
 
-def getLabelAddr(label):
-    return [ k for k in symbols if symbols[k] == label ][0]
+        self.close()
+        self.latest = latest
+        name = ""
+        if r is not None:
+            name = bytes(mem[latest+3:latest+3+(mem[latest+2] & 0x1F)]).decode("latin-1")
+        header = latest if r is not None else 0
+        self.current = { "name": name or "(start)", "header": header, "end": max(header, dp),
+                         "line": self.program.count(b"\n", 0, max(pos-1, 0)) + 1,
+                         "cycles": self.mpu.processorCycles, "seconds": time.perf_counter() }
+
+    def table(self):
+        lines = [ "%-16s %6s %10s %9s %6s" % ("definition", "line", "cycles", "ms", "bytes") ]
+        for r in sorted(self.records, key=lambda r: -r["cycles"])[:self.TOP]:
+            lines.append("%-16s %6d %10d %9.2f %6d" % (r["name"], r["line"], r["cycles"], 1000*r["seconds"], r["bytes"]))
+        total = sum(r["cycles"] for r in self.records)
+        lines.append("%d definitions, %d cycles, %.2f s" % (len(self.records) - 1, total, time.perf_counter() - self.start))
+        return "\n".join(lines)
+
+    def write(self, filename, target):
+        with open(filename, 'w') as f:
+            json.dump({ "target": target, "definitions": self.records }, f, indent=1)
+            f.write("\n")
+
+class DirectInput:
+    # Direct mode: the CPU reads the program straight from a buffer,
+    # no thread nor queue, no echo
+
+    on_read = None # on_read(pos) before each byte read
+
+    def __init__(self, program):
+        self.program = program
+        self.pos = 0
+        self.pending = False # a newline, or past the end, was read
+
+    def getc(self, address):
+        if self.on_read:
+            self.on_read(self.pos)
+        if self.pos < len(self.program):
+            c = self.program[self.pos]
+        else:
+            c = 0
+        self.pos += 1
+        if c == 0x0A or self.pos > len(self.program):
+            self.pending = True
+        return c
 
-if args.symbols:
-    symbols=parseSymbolsFile(args.symbols)
+    def starved(self):
+        return self.pos > len(self.program)
 
-# Address of symbols
-addr_NEXT = getLabelAddr("NEXT")
-addr_IP = 0xFE-2
-addr_LATEST = getLabelAddr("LATEST")
-addr_do_FIND = getLabelAddr("do_FIND")
-addr_do_0BR = getLabelAddr("do_0BR")
-addr_numberError = getLabelAddr("numberError")
+class QueueInput:
+    # Threaded mode: input typed through a queue by the main thread
 
-def cpuThread(ch, queue, emu_queue):
-    started = False
+    pending = False
 
-    def load(memory, start_address, bytes):
-        memory[start_address:start_address + len(bytes)] = bytes
+    def __init__(self, queue):
+        self.queue = queue
 
-    # def putc(address, value):
-        # if not started:
-        #     return
-        # try:
-        #     if value==0x08:
-        #         sys.stdout.write(chr(value))
-        #         sys.stdout.write(' ')
-        #     sys.stdout.write(chr(value))
-        # except UnicodeEncodeError: # Python 3
-        #     sys.stdout.write("?")
-        # sys.stdout.flush()
-
-    def getc(address):
-        while queue.empty():
-            pass
-        c = queue.get()
+    def getc(self, address):
+        c = self.queue.get() # blocks until the main thread has queued more input
         print(chr(c), end="")
         return c
 
+def run(source, checkpoints=None):
+    # Runs the stage 1 ROM until the FORTH code signals the end of the
+    # compilation, reading the input at getc_addr from source.
+    # Returns the exit code.
+
+    def load(memory, start_address, bytes):
+        memory[start_address:start_address + len(bytes)] = bytes
+
     def getByte(address):
         return mpu.memory[address]
 
     def getWord(address):
         return mpu.memory[address] + 256*mpu.memory[address+1]
 
-    def getCountedStr(addr,l=None):
-        if l==None:
-            l = getByte(addr) # length byte
-        ba = mpu.memory[addr+1:addr+l+1]
-        return "".join(map(chr,ba))
-
     def do_0BR():
         if getWord( 2 + mpu.x ) != 0x0000:
             return # not taking the branch, do nothing here
@@ -129,8 +303,7 @@ def cpuThread(ch, queue, emu_queue):
         if addr_jump_to == addr_numberError:
             print("FATAL: Word not found:",last_lookedup_word)
             print("COMPILATION ABORTED")
-            emu_queue.put(CPU_EXIT_ERROR)
-            quit(1)
+            return True
 
     def do_FIND():
         # Simulates FIND in python and bypasses our FORTH's FIND.
@@ -147,44 +320,24 @@ def cpuThread(ch, queue, emu_queue):
             # user forced Disable FIND Offloading
             return
 
-        header = getWord(addr_LATEST)
-        while True:
-            l = getByte(header+2) # get length & flags
+        # look the name up in the dictionary index (0 if not found)
+        header = dictionary.find( mpu.memory[addr:addr+l] )
 
-            if l & 0x40: # Hidden word, skip!
-                header = getWord(header)
-                continue
-
-            l = l &  0x1F # length, no flags
-            str = getCountedStr(header+2, l)
-
-            if str == word:
-                # put  header addr in 5,X, 4,X (NOS)
-                mpu.memory[4+mpu.x] = header & 0xFF
-                mpu.memory[5+mpu.x] = header >> 8
-                mpu.x = mpu.x + 2   # DROP
-                mpu.pc = addr_NEXT  #  JMP NEXT
-                break
-
-            header = getWord(header)
-
-            if header == 0:
-                mpu.memory[4+mpu.x] = 0
-                mpu.memory[5+mpu.x] = 0
-                mpu.x = mpu.x + 2
-                mpu.pc = addr_NEXT
-                break
+        # put  header addr in 5,X, 4,X (NOS)
+        mpu.memory[4+mpu.x] = header & 0xFF
+        mpu.memory[5+mpu.x] = header >> 8
+        mpu.x = mpu.x + 2   # DROP
+        mpu.pc = addr_NEXT  #  JMP NEXT
 
     mpu = CMOS65C02()
-    mpu.memory = 0x10000 * [0xEA]
-
-    addrWidth = mpu.ADDR_WIDTH
 
-    m = ObservableMemory(subject=mpu.memory, addrWidth=addrWidth)
-    # m.subscribe_to_write([putc_addr], putc)
-    m.subscribe_to_read([getc_addr], getc)
+    m = CerberusMemory()
+    m.subscribe_to_read([getc_addr], source.getc)
     mpu.memory = m
 
+    # name --> header index of the Forth dictionary, for do_FIND()
+    dictionary = DictionaryIndex(m, addr_LATEST)
+
     if args.addr and str(args.addr).startswith("0x"):
         args.addr = int(args.addr,16)
 
@@ -196,7 +349,23 @@ def cpuThread(ch, queue, emu_queue):
 
     mpu.pc=args.addr
 
-    started = True
+    if checkpoints:
+        # --costs reports every definition: start from the beginning
+        source.pos = checkpoints.resume(mpu, load=not args.costs)
+
+    costs = None
+    if args.costs and isinstance(source, DirectInput):
+        costs = CostReport(mpu, source.program)
+        source.on_read = costs.on_read
+
+    hooks = {}
+    if args.offload or args.verify_offload:
+        hle = HLE(mpu, symbols, PARSING_OFFLOADS, sample_every=0, verify=args.verify_offload)
+        hooks = hle.hooks
+
+    # blocks must end where the hooks below check the PC
+    jit = BlockCache(mpu, [addr_do_FIND, addr_do_0BR] + list(hooks)) if args.jit else None
+    step = jit.step if jit else mpu.step
 
     while True:
         # print("%04X: %02X %02X %02X" % ( mpu.pc, getByte(mpu.pc), getByte(mpu.pc+1), getByte(mpu.pc+2) ) )
@@ -207,13 +376,55 @@ def cpuThread(ch, queue, emu_queue):
         elif mpu.pc == addr_do_0BR:
             # check if we've reached the numberError condition
             # means word not found in interpreter --> abort compilation
-            do_0BR()
+            if do_0BR():
+                return CPU_EXIT_ERROR
+        elif mpu.pc in hooks:
+            # WORD, PARSE, NUMBER in python (--offload)
+            try:
+                hooks[mpu.pc]()
+            except OffloadMismatch as e:
+                print("FATAL: Offload mismatch:", e)
+                print("COMPILATION ABORTED")
+                return CPU_EXIT_ERROR
 
         if getByte(0x0000) == 0x01:
             # Means the end of compilation, exit the CPU loop
             break
 
-        mpu.step()
+        if source.pending:
+            source.pending = False
+            if source.starved():
+                print("FATAL: End of input reached before the end of compilation")
+                print("COMPILATION ABORTED")
+                return CPU_EXIT_ERROR
+            if checkpoints:
+                checkpoints.update(mpu, source.pos)
+
+        step()
+
+    dump(mpu)
+
+    if costs:
+        costs.close()
+        costs.write("costs-"+args.target+".json", args.target)
+        print(costs.table())
+
+    print(mpu.processorCycles, "clock cycles")
+    if jit:
+        print(jit.report())
+    if checkpoints and checkpoints.saved:
+        print("%d checkpoints saved" % checkpoints.saved)
+
+    return CPU_EXIT_OK
+
+def dump(mpu):
+    # Writes the rom-, ram- and last-<target>.dat files
+
+    def getByte(address):
+        return mpu.memory[address]
+
+    def getWord(address):
+        return mpu.memory[address] + 256*mpu.memory[address+1]
 
     print("Reached end of compilation! Starting the dumping" )
 
@@ -225,9 +436,7 @@ def cpuThread(ch, queue, emu_queue):
     print("  Length: %d bytes" % int(rom_end-rom_start) )
     print()
 
-    f = open("rom-"+args.target+".dat", 'wb')
-    f.write(bytearray(mpu.memory[rom_start:rom_end]))
-    f.close()
+    write_if_changed("rom-"+args.target+".dat", bytes(mpu.memory[rom_start:rom_end]))
 
     print("RAM Dictionary:")
     ram_start = getWord(0x0005)
@@ -237,9 +446,7 @@ def cpuThread(ch, queue, emu_queue):
     print("  Length: %d bytes" % int(ram_end-ram_start) )
     print()
 
-    f = open("ram-"+args.target+".dat", 'wb')
-    f.write(bytearray(mpu.memory[ram_start:ram_end]))
-    f.close()
+    write_if_changed("ram-"+args.target+".dat", bytes(mpu.memory[ram_start:ram_end]))
 
     LAST = getWord(0x0009)
     print("LAST: %04X" % LAST )
@@ -247,7 +454,7 @@ def cpuThread(ch, queue, emu_queue):
     HERE = getWord(0x0007)
     print("HERE: %04X" % HERE )
 
-    f = open("last-"+args.target+".dat", 'w')
+    f = io.StringIO()
     f.write( "; LATEST     \n")
     f.write( "LDA #$%02X   \n" % getByte(0x0009+0) )
     f.write( "STA LATEST   \n" )
@@ -259,34 +466,161 @@ def cpuThread(ch, queue, emu_queue):
     f.write( "STA DP       \n" )
     f.write( "LDA #$%02X   \n" % getByte(0x0007+1) )
     f.write( "STA DP+1     \n" )
-    f.close()
-
-    print(mpu.processorCycles, "clock cycles")
+    write_if_changed("last-"+args.target+".dat", f.getvalue().encode())
+
+def write_if_changed(filename, data):
+    # leaves the file (and its date, for make) alone if it already has
+    # that content
+    try:
+        with open(filename, 'rb') as f:
+            if f.read() == data:
+                print("%s unchanged" % filename)
+                return False
+    except FileNotFoundError:
+        pass
+    with open(filename, 'wb') as f:
+        f.write(data)
+    return True
+
+# Manifest: what the outputs of a target were compiled from, with hashes,
+# in manifest-<target>.json. When the inputs and outputs still match, there's
+# nothing to compile.
+MANIFEST_VERSION = 1
+
+def sha1_file(filename):
+    with open(filename, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+def manifest_inputs(program):
+    return { "rom": sha1_file(args.rom),
+             "symbols": sha1_file(args.symbols),
+             "source": hashlib.sha1(program).hexdigest(),
+             "options": { "addr": str(args.addr), "dfo": args.dfo, "offload": args.offload or args.verify_offload } }
+
+def output_files():
+    return [ name+"-"+args.target+".dat" for name in ("rom", "ram", "last") ]
+
+def up_to_date(filename, inputs):
+    try:
+        with open(filename) as f:
+            manifest = json.load(f)
+        return ( manifest["version"] == MANIFEST_VERSION and manifest["inputs"] == inputs and
+                 all(sha1_file(name) == manifest["outputs"][name] for name in output_files()) )
+    except (OSError, ValueError, KeyError):
+        return False
+
+def write_manifest(filename, inputs):
+    manifest = { "version": MANIFEST_VERSION, "inputs": inputs,
+                 "outputs": { name: sha1_file(name) for name in output_files() } }
+    write_if_changed(filename, (json.dumps(manifest, indent=1) + "\n").encode())
 
+def cpuThread(ch, queue, emu_queue):
     # Signal main thread it's the end
-    emu_queue.put(CPU_EXIT_OK)
-
-# We start the "computer"
-t=threading.Thread( target=cpuThread, args=("", queue, emu_queue))
-t.daemon = True
-t.start()
-
-# We feed the code to the "keyboard" as if the user was typing it
-# it's queued into a FIFO so no worries of FORTH taking it's time to
-# interpret and compiling
-if args.load:
-    f = open(args.load, 'r')
-    program = f.read()
-    f.close()
-
-    for c in program:
-        queue.put( ord(c) )
-
-# Now we wait FORTH to signal us it has finished the compilation.
-# This happens when we save "1 into 0x0000"
-# we need to catch writes to 0x0000 and when that happens, signal back to this thread.
-while emu_queue.empty():
-    pass
-
-print("CPU signaled end of compilation!")
-quit(emu_queue.get())
+    emu_queue.put(run(QueueInput(queue)))
+
+def checkpoints_key():
+    # what the state of a compilation depends on, but the input
+    h = hashlib.sha1(b"%d" % CHECKPOINT_VERSION)
+    for filename in (args.rom, args.symbols):
+        with open(filename, 'rb') as f:
+            h.update(f.read())
+    h.update(repr((args.addr, args.dfo, args.offload or args.verify_offload)).encode())
+    return h.hexdigest()
+
+def xcompile(job_args):
+    # One cross-compilation, for args.target. Returns the exit code
+    global args
+    args = job_args
+
+    load_symbols(args.symbols)
+
+    program = b""
+    if args.load:
+        f = open(args.load, 'rb')
+        program = f.read()
+        f.close()
+
+    manifest = "manifest-"+args.target+".json"
+    inputs = manifest_inputs(program)
+    if not (args.force or args.costs) and up_to_date(manifest, inputs):
+        print("%s: outputs up to date (%s), nothing to compile" % (args.target, manifest))
+        return CPU_EXIT_OK
+
+    exit_code = emulate(program)
+    if exit_code == CPU_EXIT_OK:
+        write_manifest(manifest, inputs)
+    return exit_code
+
+def emulate(program):
+    if args.threaded:
+        queue = ClearableQueue()
+        emu_queue = Queue() # CPU --> Emulator
+
+        # We start the "computer"
+        t=threading.Thread( target=cpuThread, args=("", queue, emu_queue))
+        t.daemon = True
+        t.start()
+
+        # We feed the code to the "keyboard" as if the user was typing it
+        # it's queued into a FIFO so no worries of FORTH taking it's time to
+        # interpret and compiling
+        for c in program:
+            queue.put( c )
+
+        # Now we wait FORTH to signal us it has finished the compilation.
+        # This happens when we save "1 into 0x0000"
+        # we need to catch writes to 0x0000 and when that happens, signal back to this thread.
+        exit_code = emu_queue.get()
+
+        print("CPU signaled end of compilation!")
+        return exit_code
+
+    checkpoints = None
+    if args.cache and addr_MODE is not None:
+        checkpoints = Checkpoints(args.cache, args.target, checkpoints_key(), program)
+
+    return run(DirectInput(program), checkpoints)
+
+def xcompile_job(job_args):
+    # xcompile() in a worker process, returns the exit code and the output
+    out = io.StringIO()
+    with contextlib.redirect_stdout(out):
+        try:
+            exit_code = xcompile(job_args)
+        except Exception as e:
+            print("FATAL: %s: %s" % (type(e).__name__, e))
+            exit_code = CPU_EXIT_ERROR
+    return exit_code, out.getvalue()
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+
+    signal.signal(signal.SIGINT, signal_handler)
+
+    if not args.job:
+        if not args.target:
+            parser.error("the following arguments are required: -t/--target (or -j)")
+        quit(xcompile(args))
+
+    if args.threaded:
+        parser.error("-j can't be used with --threaded")
+
+    jobs = []
+    for job in args.job:
+        fields = job.split(":")
+        if len(fields) != 3 or not all(fields):
+            parser.error("bad job %r, expected ROM:SYMBOLS:TARGET" % job)
+        rom, symbols_file, target = fields
+        jobs.append(argparse.Namespace(**dict(vars(args), rom=rom, symbols=symbols_file, target=target)))
+
+    # the targets are independent: each one in its own process, the output
+    # is shown per target once they are all done
+    with ProcessPoolExecutor(max_workers=len(jobs)) as pool:
+        results = list(pool.map(xcompile_job, jobs))
+
+    exit_code = CPU_EXIT_OK
+    for job, (code, output) in zip(jobs, results):
+        print("=== %s (%s) ===" % (job.target, job.rom))
+        print(output, end="")
+        exit_code = max(exit_code, code)
+    quit(exit_code)